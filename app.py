@@ -1,5 +1,6 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import oracledb
 import os
 import time
@@ -7,9 +8,16 @@ import sys
 import re
 import requests
 import logging
+import threading
+import json
+import unicodedata
+import hashlib
+import sqlite3
 from dotenv import load_dotenv
 from sqlalchemy import create_engine, text
 from io import BytesIO
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from PIL import Image
 
@@ -39,10 +47,13 @@ load_dotenv()
 if 'search_results' not in st.session_state:
     st.session_state.search_results = {}
 
+# Candidatos já baixados de cada busca (mesma chave de search_results)
+if 'search_candidates' not in st.session_state:
+    st.session_state.search_candidates = {}
+
 if 'api_quota' not in st.session_state:
     st.session_state.api_quota = {
         'count': 0, 
-        'reset_time': time.time() + 3600,
         'history': []
     }
 
@@ -63,15 +74,33 @@ except Exception as e:
         logger.error(f"Erro Oracle Client: {e}")
 
 # --- 2. CONEXÃO E DADOS ---
+@st.cache_resource
 def get_db_engine():
-    """Cria engine de conexão com Oracle"""
+    """
+    Cria a engine de conexão com Oracle (uma por processo).
+    
+    O pool de conexões é compartilhado por todas as sessões; pre-ping
+    descarta conexões mortas e o recycle evita timeouts do firewall/servidor.
+    """
     user = os.getenv("DB_USER")
     password = os.getenv("DB_PASSWORD")
     host = os.getenv("DB_HOST")
     port = os.getenv("DB_PORT")
     service = os.getenv("DB_SERVICE")
     connection_string = f"oracle+oracledb://{user}:{password}@{host}:{port}/?service_name={service}"
-    return create_engine(connection_string)
+    
+    engine = create_engine(
+        connection_string,
+        pool_size=int(os.getenv("DB_POOL_SIZE", "5")),
+        max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "5")),
+        pool_timeout=int(os.getenv("DB_POOL_TIMEOUT", "30")),
+        pool_recycle=int(os.getenv("DB_POOL_RECYCLE", "1800")),
+        pool_pre_ping=True,
+        connect_args={"stmtcachesize": int(os.getenv("DB_STMT_CACHE_SIZE", "50"))}
+    )
+    logger.info(f"Pool de conexões Oracle criado (pool_size={engine.pool.size()})")
+    return engine
+
 # ============================================
 # FUNÇÕES AUXILIARES PARA MÚLTIPLOS EANs
 # ============================================
@@ -135,14 +164,291 @@ def get_primary_ean(row):
     return eans[0] if eans else None
 
 
+def build_ean_index(df):
+    """
+    Monta o índice invertido de EANs do catálogo (uma vez por carga).
+
+    Estrutura:
+        - eans: array ordenado com todos os EANs distintos
+        - exato: dicionário EAN -> posição em 'eans'
+        - inicio_cods / codprods: para o EAN i, os produtos são
+          codprods[inicio_cods[i]:inicio_cods[i + 1]]
+        - texto / inicios: EANs concatenados por '\\n' e a posição
+          inicial de cada um, para busca parcial (substring)
+    """
+    produtos = df[['CODPROD', 'TODOS_EANS']].drop_duplicates('CODPROD')
+    pares = (
+        produtos.set_index('CODPROD')['TODOS_EANS']
+        .astype(object)
+        .map(parse_eans)
+        .explode()
+        .dropna()
+    )
+
+    eans_todos = pares.to_numpy(dtype=str)
+    cods_todos = pares.index.to_numpy()
+    ordem = np.argsort(eans_todos, kind='stable')
+    eans_ordenados = eans_todos[ordem]
+
+    eans, inicio_cods = np.unique(eans_ordenados, return_index=True)
+    inicio_cods = np.append(inicio_cods, len(eans_ordenados))
+
+    return _ean_index(eans, inicio_cods, cods_todos[ordem])
+
+
+def _ean_index(eans, inicio_cods, codprods):
+    """Completa o índice de EANs com as estruturas derivadas de 'eans'"""
+    comprimentos = np.array([len(ean) for ean in eans], dtype=np.int64)
+    inicios = np.concatenate(([0], np.cumsum(comprimentos + 1)[:-1])) if len(eans) else comprimentos
+
+    return {
+        'eans': eans,
+        'exato': {ean: i for i, ean in enumerate(eans)},
+        'inicio_cods': inicio_cods,
+        'codprods': codprods,
+        'texto': "\n".join(eans),
+        'inicios': inicios,
+        'maior_ean': int(comprimentos.max()) if len(eans) else 0
+    }
+
+
+def lookup_ean(index, busca):
+    """
+    Retorna os CODPROD que possuem algum EAN contendo 'busca'.
+    Mesma semântica de has_ean (busca exata ou parcial), sem varrer o catálogo.
+    """
+    busca = str(busca).strip() if busca else ""
+    if not busca or index is None:
+        return np.array([], dtype=np.int64)
+
+    if len(busca) >= index['maior_ean']:
+        # Nenhum EAN maior pode conter a busca: basta o hash exato
+        posicao = index['exato'].get(busca)
+        ids = np.array([] if posicao is None else [posicao], dtype=np.int64)
+    else:
+        texto = index['texto']
+        ocorrencias = []
+        pos = texto.find(busca)
+        while pos != -1:
+            ocorrencias.append(pos)
+            pos = texto.find(busca, pos + 1)
+        ids = np.unique(np.searchsorted(index['inicios'], ocorrencias, side='right') - 1)
+
+    if len(ids) == 0:
+        return np.array([], dtype=np.int64)
+
+    inicio_cods = index['inicio_cods']
+    codprods = np.concatenate([
+        index['codprods'][inicio_cods[i]:inicio_cods[i + 1]] for i in ids
+    ])
+    return np.unique(codprods)
+
+
+# ============================================
+# ÍNDICE DE PALAVRAS DAS DESCRIÇÕES
+# ============================================
+
+def normalize_description(texto):
+    """
+    Normaliza uma descrição (ou busca) para o índice: remove unidades com as
+    mesmas regras do clean_text, tira os acentos e passa para minúsculas.
+    """
+    texto = unicodedata.normalize('NFKD', clean_text(str(texto)))
+    return "".join(c for c in texto if not unicodedata.combining(c)).lower()
+
+
+def build_description_index(produtos):
+    """
+    Monta o índice invertido de palavras das descrições (uma vez por carga).
+
+    Estrutura:
+        - tokens: array ordenado com as palavras distintas
+        - inicio / posicoes: para a palavra i, as posições (iloc) dos produtos
+          são posicoes[inicio[i]:inicio[i + 1]]; como os tokens estão
+          ordenados, todas as palavras com um prefixo formam uma faixa contínua
+        - qtd_tokens: quantidade de palavras de cada produto (desempate)
+    """
+    palavras = produtos['DESCRICAO'].astype(object).fillna("").map(
+        lambda desc: normalize_description(desc).split()
+    )
+    pares = (
+        pd.DataFrame({'posicao': np.arange(len(produtos)), 'token': palavras.to_numpy()})
+        .explode('token')
+        .dropna()
+        .drop_duplicates()
+    )
+
+    tokens_todos = pares['token'].to_numpy(dtype=str)
+    posicoes_todas = pares['posicao'].to_numpy(dtype=np.int32)
+    ordem = np.argsort(tokens_todos, kind='stable')
+    tokens_ordenados = tokens_todos[ordem]
+
+    tokens, inicio = np.unique(tokens_ordenados, return_index=True)
+
+    return {
+        'tokens': tokens,
+        'inicio': np.append(inicio, len(tokens_ordenados)),
+        'posicoes': posicoes_todas[ordem],
+        'qtd_tokens': np.maximum(palavras.map(len).to_numpy(), 1)
+    }
+
+
+def search_descriptions(index, busca):
+    """
+    Busca por palavras: todas as palavras da busca precisam aparecer (E),
+    cada uma como palavra inteira ou início de palavra, em qualquer ordem.
+
+    Returns:
+        (posições dos produtos, relevância) ou None se a busca não tem
+        palavras indexáveis (ex.: só unidades)
+    """
+    termos = list(dict.fromkeys(normalize_description(busca).split()))
+    if not termos:
+        return None
+
+    tokens = index['tokens']
+    inicio = index['inicio']
+    total = len(index['qtd_tokens'])
+    casou = np.ones(total, dtype=bool)
+    pontos = np.zeros(total, dtype=np.float32)
+
+    for termo in termos:
+        primeiro = np.searchsorted(tokens, termo, side='left')
+        ultimo = np.searchsorted(tokens, termo + '\uffff', side='left')
+
+        pontos_termo = np.zeros(total, dtype=np.float32)
+        # Início de palavra vale 1, palavra inteira vale 2
+        pontos_termo[index['posicoes'][inicio[primeiro]:inicio[ultimo]]] = 1
+        if primeiro < len(tokens) and tokens[primeiro] == termo:
+            pontos_termo[index['posicoes'][inicio[primeiro]:inicio[primeiro + 1]]] = 2
+
+        casou &= pontos_termo > 0
+        pontos += pontos_termo
+
+    posicoes = np.flatnonzero(casou)
+    # Desempate: descrições mais curtas (a busca cobre mais do produto)
+    relevancia = pontos[posicoes] + 1.0 / index['qtd_tokens'][posicoes]
+    return posicoes, relevancia
+
+
+# ============================================
+# BUSCA APROXIMADA (TRIGRAMAS)
+# ============================================
+
+FUZZY_TOP_K = int(os.getenv("FUZZY_TOP_K", "50"))
+FUZZY_MIN_SCORE = float(os.getenv("FUZZY_MIN_SCORE", "0.3"))
+FUZZY_EXTRA_WEIGHT = 0.1
+# Colunas com índice de trigramas no catálogo
+TRIGRAM_COLUMNS = ('DESCRICAO', 'FORNECEDOR')
+
+
+def _trigrams(texto):
+    """Trigramas de cada palavra (com espaços nas bordas, como o pg_trgm)"""
+    texto = unicodedata.normalize('NFKD', str(texto))
+    texto = "".join(c for c in texto if not unicodedata.combining(c)).lower()
+    trigramas = set()
+    for palavra in re.sub(r'[^a-z0-9]+', ' ', texto).split():
+        palavra = f"  {palavra} "
+        trigramas.update(palavra[i:i + 3] for i in range(len(palavra) - 2))
+    return trigramas
+
+
+def build_trigram_index(textos):
+    """
+    Monta o índice de trigramas de uma coluna de texto (uma linha por produto).
+
+    Estrutura:
+        - vocabulario: trigrama -> id
+        - inicio / posicoes: para o trigrama i, as posições (iloc) dos
+          produtos são posicoes[inicio[i]:inicio[i + 1]]
+        - qtd: quantidade de trigramas distintos de cada produto
+    """
+    vocabulario = {}
+    por_texto = {}  # textos repetidos (ex.: fornecedor) são processados uma vez
+    ids = []
+    qtd = np.zeros(len(textos), dtype=np.int32)
+    for posicao, texto in enumerate(textos.astype(object).fillna("")):
+        ids_texto = por_texto.get(texto)
+        if ids_texto is None:
+            ids_texto = por_texto[texto] = [
+                vocabulario.setdefault(t, len(vocabulario)) for t in _trigrams(texto)
+            ]
+        qtd[posicao] = len(ids_texto)
+        ids.extend(ids_texto)
+
+    ids = np.asarray(ids, dtype=np.int32)
+    posicoes = np.repeat(np.arange(len(textos), dtype=np.int32), qtd)
+    ordem = np.argsort(ids, kind='stable')
+
+    return {
+        'vocabulario': vocabulario,
+        'inicio': np.searchsorted(ids[ordem], np.arange(len(vocabulario) + 1)),
+        'posicoes': posicoes[ordem],
+        'qtd': qtd
+    }
+
+
+def trigram_similarity(index, busca):
+    """
+    Similaridade (0 a 1) da busca com cada produto, pelo índice de Tversky
+    dos trigramas: trigramas da busca que faltam no produto pesam 1 e os que
+    sobram no produto pesam FUZZY_EXTRA_WEIGHT, então uma busca curta ainda
+    encontra descrições longas, com leve preferência pelas mais curtas.
+
+    Returns:
+        Array com a similaridade de todas as posições do índice
+    """
+    trigramas = _trigrams(busca)
+    total = len(index['qtd'])
+    if not trigramas:
+        return np.zeros(total, dtype=np.float32)
+
+    inicio = index['inicio']
+    ids = [index['vocabulario'][t] for t in trigramas if t in index['vocabulario']]
+    if not ids:
+        return np.zeros(total, dtype=np.float32)
+
+    ocorrencias = np.concatenate([index['posicoes'][inicio[i]:inicio[i + 1]] for i in ids])
+    comuns = np.bincount(ocorrencias, minlength=total).astype(np.float32)
+    return comuns / (len(trigramas) + FUZZY_EXTRA_WEIGHT * (index['qtd'] - comuns))
+
+
+def fuzzy_search(catalogo, busca, candidatos, incluir_fornecedor=False, top_k=FUZZY_TOP_K):
+    """
+    Os top_k produtos (entre os candidatos) mais parecidos com a busca.
+
+    Returns:
+        (posições dos produtos, similaridade de cada produto do catálogo)
+    """
+    similaridade = trigram_similarity(catalogo['trigram_index']['DESCRICAO'], busca)
+    if incluir_fornecedor:
+        similaridade = np.maximum(
+            similaridade, trigram_similarity(catalogo['trigram_index']['FORNECEDOR'], busca)
+        )
+
+    pontos = similaridade[candidatos]
+    validos = np.flatnonzero(pontos >= FUZZY_MIN_SCORE)
+    if len(validos) > top_k:
+        validos = validos[np.argpartition(-pontos[validos], top_k - 1)[:top_k]]
+    return candidatos[validos], similaridade
+
+
 # ============================================
 # ATUALIZAÇÃO DO FETCH_PRODUCT_DATA
 # ============================================
 
-@st.cache_data(ttl=300)
-def fetch_product_data():
-    """Busca dados do Oracle COM suporte a múltiplos EANs e cache de 5 minutos"""
-    query = """
+# Tempo de vida do catálogo em memória e modo de atualização
+# ("incremental" busca apenas linhas alteradas, "full" recarrega tudo)
+CATALOG_TTL = int(os.getenv("CATALOG_TTL", "300"))
+CATALOG_REFRESH_MODE = os.getenv("CATALOG_REFRESH_MODE", "incremental").lower()
+
+# Limite de itens por cláusula IN do Oracle
+ORACLE_IN_LIMIT = 1000
+
+# Filiais consideradas no catálogo (ex.: "1,2,3,7")
+CATALOG_FILIAIS = [int(f) for f in os.getenv("CATALOG_FILIAIS", "1,2,3").split(",") if f.strip()]
+
+PRODUCT_QUERY = """
     WITH EmbalagemPrincipal AS (
         SELECT 
             CODPROD, 
@@ -176,7 +482,7 @@ def fetch_product_data():
     ProdutosAtivos AS (
         SELECT DISTINCT CODPROD 
         FROM PCEST
-        WHERE CODFILIAL IN (1, 2, 3) 
+        WHERE CODFILIAL IN ({filiais}) 
     )
     SELECT
         P.CODPROD, 
@@ -206,282 +512,2724 @@ def fetch_product_data():
     LEFT JOIN PCFORNEC F ON P.CODFORNEC = F.CODFORNEC
     LEFT JOIN PCDEPTO D ON P.CODEPTO = D.CODEPTO
     LEFT JOIN PCSECAO S ON P.CODSEC = S.CODSEC
-    WHERE E.CODFILIAL IN (1, 2, 3)
-    ORDER BY P.CODPROD
+    WHERE E.CODFILIAL IN ({filiais})
+    {filtro_extra}
+"""
+
+# Assinatura de cada linha (produto + filial) calculada no Oracle.
+# DIAS_SEM_VENDA fica de fora pois muda todo dia; é recalculado localmente.
+# TODOS_EANS entra em um hash separado para não estourar o limite de 4000 bytes.
+ROW_HASH_EXPR = """ORA_HASH(
+        NVL(V.TODOS_EANS, '-'), 4294967295,
+        ORA_HASH(
+            V.DESCRICAO || '|' || V.EAN || '|' || V.EMBALAGEM || '|' ||
+            V.QTD_EANS || '|' || V.QTEST || '|' ||
+            TO_CHAR(V.DTULTSAIDA, 'YYYYMMDDHH24MISS') || '|' ||
+            V.DIRFOTOPROD || '|' || TO_CHAR(V.DTEXCLUSAO, 'YYYYMMDDHH24MISS') || '|' ||
+            V.FORNECEDOR || '|' || V.DEPARTAMENTO || '|' || V.SECAO || '|' || V.STATUS
+        )
+    )"""
+
+
+def build_product_query(colunas="V.*", filtro_extra="", ordem="V.CODPROD"):
     """
+    Monta a consulta do catálogo.
     
-    engine = get_db_engine()
-    try:
+    Args:
+        colunas: Lista de colunas sobre a visão V (ex: "V.*" ou "V.CODPROD")
+        filtro_extra: Condição adicional aplicada junto ao filtro de filial
+        ordem: Expressão do ORDER BY sobre a visão V
+    
+    Returns:
+        Tupla (sql, binds das filiais de CATALOG_FILIAIS)
+    """
+    binds = {f"filial{i}": filial for i, filial in enumerate(CATALOG_FILIAIS)}
+    base = PRODUCT_QUERY.format(
+        filiais=", ".join(f":{nome}" for nome in binds),
+        filtro_extra=filtro_extra
+    )
+    return f"SELECT {colunas} FROM ({base}) V ORDER BY {ordem}", binds
+
+
+def _recalcular_dias_sem_venda(df):
+    """Recalcula DIAS_SEM_VENDA localmente (equivalente a TRUNC(SYSDATE - DTULTSAIDA))"""
+    ultima_saida = pd.to_datetime(df['DTULTSAIDA'], errors='coerce')
+    dias = (pd.Timestamp.now() - ultima_saida) / pd.Timedelta(days=1)
+    df['DIAS_SEM_VENDA'] = np.trunc(dias.astype(float))
+    return df
+
+
+def _separar_hashes(df):
+    """Remove a coluna HASH_LINHA do catálogo e a devolve como tabela à parte"""
+    hashes = df[['CODPROD', 'CODFILIAL', 'HASH_LINHA']].copy()
+    return df.drop(columns=['HASH_LINHA']), hashes
+
+
+# Carga direta pelo python-oracledb (sem montar tuplas de todas as linhas)
+ORACLE_FAST_FETCH = os.getenv("ORACLE_FAST_FETCH", "1") == "1"
+# Linhas por ida ao banco; prefetchrows usa o mesmo valor na primeira ida
+ORACLE_FETCH_ARRAYSIZE = int(os.getenv("ORACLE_FETCH_ARRAYSIZE", "5000"))
+
+ORACLE_DATE_TYPES = (oracledb.DB_TYPE_DATE, oracledb.DB_TYPE_TIMESTAMP)
+ORACLE_NUMBER_TYPES = (
+    oracledb.DB_TYPE_NUMBER, oracledb.DB_TYPE_BINARY_DOUBLE,
+    oracledb.DB_TYPE_BINARY_FLOAT, oracledb.DB_TYPE_BINARY_INTEGER
+)
+
+
+def _oracle_array(valores, tipo):
+    """Converte os valores de uma coluna em um lote para um array tipado (None vira NaN/NaT)"""
+    if tipo in ORACLE_NUMBER_TYPES:
+        return np.array(valores, dtype=np.float64)
+    # fromiter evita a inspeção item a item do np.array (lenta com datetimes)
+    objetos = np.fromiter(valores, dtype=object, count=len(valores))
+    if tipo in ORACLE_DATE_TYPES:
+        return pd.to_datetime(objetos).to_numpy()
+    return objetos
+
+
+def _finalizar_coluna(partes, tipo):
+    """Junta os lotes de uma coluna; números inteiros sem nulos voltam a int64"""
+    coluna = np.concatenate(partes) if partes else _oracle_array([], tipo)
+    if tipo in ORACLE_NUMBER_TYPES and len(coluna):
+        inteiros = np.isfinite(coluna).all() and (coluna == np.trunc(coluna)).all()
+        if inteiros and np.abs(coluna).max() < 2**53:
+            coluna = coluna.astype(np.int64)
+    return coluna
+
+
+def read_oracle_frame(connection, query, params=None):
+    """
+    Executa a consulta direto no python-oracledb e monta o DataFrame coluna a
+    coluna, lote a lote: só as linhas de um fetchmany existem como tuplas ao
+    mesmo tempo, e cada lote já vira arrays numpy tipados.
+    
+    Args:
+        connection: Conexão SQLAlchemy (o cursor usa a conexão oracledb do pool)
+        query: SQL com binds nomeados (:nome)
+        params: Valores dos binds
+    """
+    if not ORACLE_FAST_FETCH:
+        return pd.read_sql(text(query), connection, params=params)
+    
+    inicio = time.time()
+    with closing(connection.connection.driver_connection.cursor()) as cursor:
+        cursor.arraysize = ORACLE_FETCH_ARRAYSIZE
+        cursor.prefetchrows = ORACLE_FETCH_ARRAYSIZE
+        cursor.execute(query, params or {})
+        
+        nomes = [col[0].upper() for col in cursor.description]
+        tipos = [col[1] for col in cursor.description]
+        partes = [[] for _ in nomes]
+        total = 0
+        
+        while True:
+            linhas = cursor.fetchmany(ORACLE_FETCH_ARRAYSIZE)
+            if not linhas:
+                break
+            total += len(linhas)
+            for i, valores in enumerate(zip(*linhas)):
+                partes[i].append(_oracle_array(valores, tipos[i]))
+            del linhas
+    
+    df = pd.DataFrame({
+        nome: _finalizar_coluna(partes[i], tipos[i]) for i, nome in enumerate(nomes)
+    })
+    duracao = time.time() - inicio
+    logger.info(
+        f"Oracle: {total:,} linhas em {duracao:.2f}s "
+        f"({total / max(duracao, 1e-6):,.0f} linhas/s, arraysize={ORACLE_FETCH_ARRAYSIZE})"
+    )
+    return df
+
+
+# Faixas de CODPROD carregadas em paralelo, cada uma em uma conexão do pool
+# (manter abaixo de DB_POOL_SIZE + DB_MAX_OVERFLOW)
+CATALOG_LOAD_PARTITIONS = int(os.getenv("CATALOG_LOAD_PARTITIONS", "4"))
+
+# Maior CODPROD de cada faixa, com quantidades parecidas de linhas de estoque
+PARTITION_BOUNDS_QUERY = """
+    SELECT MAX(CODPROD) AS LIMITE
+    FROM (
+        SELECT CODPROD, NTILE(:partes) OVER (ORDER BY CODPROD) AS FAIXA
+        FROM PCEST
+        WHERE CODFILIAL IN ({filiais})
+    )
+    GROUP BY FAIXA
+"""
+
+
+def _catalog_partitions(connection, partes):
+    """
+    Divide o catálogo em faixas (de, até] de CODPROD.
+    
+    A primeira e a última faixa ficam abertas (None), cobrindo produtos
+    criados entre esta consulta e a carga.
+    """
+    if partes <= 1:
+        return [(None, None)]
+    
+    binds = {f"filial{i}": filial for i, filial in enumerate(CATALOG_FILIAIS)}
+    query = PARTITION_BOUNDS_QUERY.format(filiais=", ".join(f":{nome}" for nome in binds))
+    limites = read_oracle_frame(connection, query, {**binds, 'partes': partes})
+    # O último limite é o fim do catálogo (faixa aberta); produtos em duas filiais
+    # podem repetir o limite de faixas vizinhas
+    limites = sorted(set(limites.iloc[:, 0].dropna().astype(int)))[:-1]
+    
+    bordas = [None] + limites + [None]
+    return list(zip(bordas[:-1], bordas[1:]))
+
+
+def _read_catalog_partitioned(engine, colunas):
+    """
+    Executa a consulta do catálogo em faixas de CODPROD, em paralelo.
+    
+    Cada faixa já vem ordenada por CODPROD e as faixas são concatenadas na
+    ordem, então o resultado tem a mesma ordem da consulta única.
+    """
+    with engine.connect() as connection:
+        faixas = _catalog_partitions(connection, CATALOG_LOAD_PARTITIONS)
+    
+    def carregar(faixa):
+        de, ate = faixa
+        condicoes, binds = [], {}
+        if de is not None:
+            condicoes.append("AND P.CODPROD > :cod_de")
+            binds['cod_de'] = de
+        if ate is not None:
+            condicoes.append("AND P.CODPROD <= :cod_ate")
+            binds['cod_ate'] = ate
+        query, params = build_product_query(colunas=colunas, filtro_extra="\n    ".join(condicoes))
         with engine.connect() as connection:
-            df = pd.read_sql(text(query), connection)
-            df.columns = df.columns.str.upper()
-            
-            # Log de estatísticas
-            produtos_com_multiplos_eans = len(df[df['QTD_EANS'] > 1])
-            logger.info(f"Dados carregados: {len(df)} produtos")
-            logger.info(f"Produtos com múltiplos EANs: {produtos_com_multiplos_eans}")
-            
-            return df
-    except Exception as e:
-        st.error(f"❌ Erro ao buscar dados: {e}")
-        logger.error(f"Erro SQL: {e}")
-        return pd.DataFrame()
-# --- 3. CONTROLE DE COTAS DA API ---
-def check_quota():
-    """Limita a 100 buscas por hora (limite gratuito do Google)"""
-    now = time.time()
-    
-    # Reset do contador após 1 hora
-    if now > st.session_state.api_quota['reset_time']:
-        st.session_state.api_quota = {
-            'count': 0, 
-            'reset_time': now + 3600,
-            'history': []
+            return read_oracle_frame(connection, query, {**params, **binds})
+    
+    inicio = time.time()
+    if len(faixas) == 1:
+        partes = [carregar(faixas[0])]
+    else:
+        with ThreadPoolExecutor(max_workers=len(faixas), thread_name_prefix="carga-catalogo") as pool:
+            partes = list(pool.map(carregar, faixas))
+    
+    df = pd.concat(partes, ignore_index=True)
+    df.columns = df.columns.str.upper()
+    logger.info(f"Catálogo lido em {len(faixas)} faixa(s) em paralelo: {len(df):,} linhas em {time.time() - inicio:.2f}s")
+    return df
+
+
+def _load_full_catalog(engine):
+    """Carrega o catálogo completo, com o hash de cada linha"""
+    df = _read_catalog_partitioned(engine, colunas=f"V.*, {ROW_HASH_EXPR} AS HASH_LINHA")
+    return _separar_hashes(df)
+
+
+def _load_catalog_rows(connection, codprods):
+    """Carrega apenas as linhas dos produtos informados (em lotes de 1000 binds)"""
+    partes = []
+    query_cols = f"V.*, {ROW_HASH_EXPR} AS HASH_LINHA"
+    for inicio in range(0, len(codprods), ORACLE_IN_LIMIT):
+        lote = codprods[inicio:inicio + ORACLE_IN_LIMIT]
+        params = {f"c{i}": int(cod) for i, cod in enumerate(lote)}
+        binds = ", ".join(f":{nome}" for nome in params)
+        query, params_filiais = build_product_query(
+            colunas=query_cols,
+            filtro_extra=f"AND P.CODPROD IN ({binds})"
+        )
+        parte = read_oracle_frame(connection, query, {**params_filiais, **params})
+        parte.columns = parte.columns.str.upper()
+        partes.append(parte)
+    
+    return _separar_hashes(pd.concat(partes, ignore_index=True))
+
+
+def _find_changed_products(engine, hashes_antigos):
+    """
+    Compara os hashes atuais do Oracle com os do último snapshot.
+    
+    Returns:
+        Tupla (lista de CODPROD alterados/novos/removidos, tabela de hashes atual)
+    """
+    hashes_novos = _read_catalog_partitioned(
+        engine, colunas=f"V.CODPROD, V.CODFILIAL, {ROW_HASH_EXPR} AS HASH_LINHA"
+    )
+    
+    comparacao = hashes_antigos.merge(
+        hashes_novos,
+        on=['CODPROD', 'CODFILIAL'],
+        how='outer',
+        suffixes=('_ANTIGO', '_NOVO'),
+        indicator=True
+    )
+    diferentes = (
+        (comparacao['_merge'] != 'both') |
+        (comparacao['HASH_LINHA_ANTIGO'] != comparacao['HASH_LINHA_NOVO'])
+    )
+    alterados = comparacao.loc[diferentes, 'CODPROD'].unique().tolist()
+    return alterados, hashes_novos
+
+
+def _apply_delta(catalogo, hashes, engine):
+    """Busca e mescla no snapshot apenas os produtos alterados desde a última carga"""
+    alterados, hashes_novos = _find_changed_products(engine, hashes)
+    produtos, estoque = catalogo['produtos'], catalogo['estoque']
+    
+    if alterados:
+        with engine.connect() as connection:
+            df_alterados, _ = _load_catalog_rows(connection, alterados)
+        novos_produtos, novo_estoque = split_catalog(df_alterados)
+        
+        produtos = pd.concat(
+            [produtos[~produtos['CODPROD'].isin(alterados)], novos_produtos],
+            ignore_index=True
+        ).sort_values('CODPROD', kind='stable')
+        estoque = pd.concat(
+            [estoque[~estoque['CODPROD'].isin(alterados)], novo_estoque],
+            ignore_index=True
+        ).sort_values('CODPROD', kind='stable')
+    
+    logger.info(f"Atualização incremental: {len(alterados)} produtos alterados")
+    return produtos, _recalcular_dias_sem_venda(estoque.copy()), hashes_novos
+
+
+# Modelo normalizado: uma linha por produto + uma linha por produto/filial
+PRODUCT_COLUMNS = [
+    'CODPROD', 'DESCRICAO', 'EAN', 'EMBALAGEM', 'TODOS_EANS', 'QTD_EANS',
+    'DIRFOTOPROD', 'DTEXCLUSAO', 'FORNECEDOR', 'DEPARTAMENTO', 'SECAO', 'STATUS'
+]
+STOCK_COLUMNS = ['CODPROD', 'CODFILIAL', 'QTEST', 'DTULTSAIDA', 'DIAS_SEM_VENDA']
+
+# Ordem das colunas na visão por filial (a mesma da consulta original)
+CATALOG_COLUMNS = [
+    'CODPROD', 'DESCRICAO', 'EAN', 'EMBALAGEM', 'TODOS_EANS', 'QTD_EANS',
+    'CODFILIAL', 'QTEST', 'DTULTSAIDA', 'DIRFOTOPROD', 'DTEXCLUSAO',
+    'FORNECEDOR', 'DEPARTAMENTO', 'SECAO', 'STATUS', 'DIAS_SEM_VENDA', 'STATUS_FOTO'
+]
+
+
+def split_catalog(df):
+    """Separa o resultado da consulta (uma linha por produto/filial) em produtos e estoque"""
+    produtos = df.drop_duplicates('CODPROD')[PRODUCT_COLUMNS].reset_index(drop=True)
+    estoque = df[STOCK_COLUMNS].reset_index(drop=True)
+    return produtos, estoque
+
+
+# Colunas de texto de baixa cardinalidade, guardadas como categorias
+CATEGORY_COLUMNS = [
+    'EMBALAGEM', 'FORNECEDOR', 'DEPARTAMENTO', 'SECAO', 'STATUS', 'STATUS_FOTO'
+]
+
+
+def optimize_catalog_dtypes(df):
+    """
+    Compacta uma tabela do catálogo: textos repetidos viram categorias e os
+    números são reduzidos ao menor tipo que comporta os valores.
+    
+    Returns:
+        Tupla (DataFrame compactado, MB antes, MB depois)
+    """
+    antes = df.memory_usage(deep=True).sum() / 1024**2
+    
+    for col in CATEGORY_COLUMNS:
+        if col in df.columns:
+            df[col] = df[col].astype('category')
+    
+    for col in ['CODPROD', 'CODFILIAL']:
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], downcast='integer')
+    
+    for col in ['QTEST', 'QTD_EANS', 'DIAS_SEM_VENDA']:
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], downcast='float')
+    
+    depois = df.memory_usage(deep=True).sum() / 1024**2
+    return df, antes, depois
+
+
+def _status_foto(dirfotoprod):
+    """Indicador visual ✅/❌ a partir da coluna DIRFOTOPROD"""
+    tem_foto = dirfotoprod.notna() & (dirfotoprod != '')
+    return np.where(tem_foto, '✅', '❌')
+
+
+def build_catalog(produtos, estoque, versao, indices=None):
+    """
+    Monta o snapshot consumido pela interface.
+    
+    O snapshot é tratado como imutável: quem precisa alterá-lo monta um
+    novo dicionário e troca a referência no store.
+    
+    Args:
+        indices: Índices de busca já montados para estes produtos (ex.: lidos
+            do snapshot em disco); se None, são calculados aqui
+    """
+    produtos = produtos.reset_index(drop=True)
+    estoque = estoque.reset_index(drop=True)
+    
+    # Coluna visual de status da foto (calculada uma vez por carga)
+    produtos['STATUS_FOTO'] = _status_foto(produtos['DIRFOTOPROD'])
+    
+    produtos, mb_prod_antes, mb_prod = optimize_catalog_dtypes(produtos)
+    estoque, mb_est_antes, mb_est = optimize_catalog_dtypes(estoque)
+    
+    if indices is None:
+        indices = {
+            'ean_index': build_ean_index(produtos),
+            'desc_index': build_description_index(produtos),
+            'trigram_index': {
+                col: build_trigram_index(produtos[col]) for col in TRIGRAM_COLUMNS
+            }
         }
-        logger.info("Quota de API resetada")
     
-    # Verifica limite
-    if st.session_state.api_quota['count'] >= 100:
-        tempo_restante = int((st.session_state.api_quota['reset_time'] - now) / 60)
-        st.warning(f"⚠️ Limite de 100 buscas/hora atingido. Aguarde {tempo_restante} minutos.")
-        return False
+    return {
+        'produtos': produtos,
+        'estoque': estoque,
+        # Para cada linha de estoque, a posição do produto correspondente
+        'pos_produto': np.searchsorted(
+            produtos['CODPROD'].to_numpy(), estoque['CODPROD'].to_numpy()
+        ),
+        **indices,
+        'facetas': build_facets(produtos, estoque),
+        'memoria_mb': (mb_prod_antes + mb_est_antes, mb_prod + mb_est),
+        'versao': versao
+    }
+
+
+@st.cache_resource
+def get_catalog_store():
+    """Snapshot do catálogo compartilhado por todas as sessões do processo"""
+    return {
+        'catalogo': None,
+        'hashes': None,
+        'atualizado_em': 0.0,
+        'carregado_em': None,
+        'duracao': None,
+        'origem': None,
+        'atualizando': False,
+        'erro': None,
+        # Fotos gravadas durante uma carga, reaplicadas na troca do snapshot
+        'fotos_na_carga': None,
+        # 'lock' protege só as trocas do snapshot (rápidas); 'lock_carga'
+        # serializa as cargas do Oracle, que rodam sem segurar o 'lock'
+        'lock': threading.Lock(),
+        'lock_carga': threading.Lock()
+    }
+
+
+def refresh_catalog(store, full=False, engine=None):
+    """
+    Atualiza o snapshot do catálogo.
     
-    st.session_state.api_quota['count'] += 1
-    return True
+    Na primeira carga (ou com full=True / CATALOG_REFRESH_MODE=full) executa
+    a consulta completa; depois busca apenas os produtos cujo hash mudou.
+    O resultado também é gravado em disco (ver save_catalog_snapshot).
+    """
+    inicio = time.time()
+    with store['lock']:
+        atual, hashes_atuais = store['catalogo'], store['hashes']
+        store['fotos_na_carga'] = {}
+    
+    # Consulta e montagem sem segurar o lock: as sessões e a gravação de
+    # fotos continuam usando o snapshot atual
+    try:
+        engine = engine or get_db_engine()
+        incremental = (
+            not full
+            and CATALOG_REFRESH_MODE == "incremental"
+            and atual is not None
+        )
+        if incremental:
+            produtos, estoque, hashes = _apply_delta(atual, hashes_atuais, engine)
+        else:
+            df, hashes = _load_full_catalog(engine)
+            produtos, estoque = split_catalog(df)
+        
+        catalogo = build_catalog(produtos, estoque, versao=0)
+    except Exception:
+        store['fotos_na_carga'] = None
+        raise
+    
+    # Log de estatísticas
+    produtos = catalogo['produtos']
+    produtos_com_multiplos_eans = len(produtos[produtos['QTD_EANS'] > 1])
+    logger.info(f"Dados carregados: {len(produtos)} produtos, {len(catalogo['estoque'])} linhas de estoque")
+    logger.info(f"Produtos com múltiplos EANs: {produtos_com_multiplos_eans}")
+    mb_antes, mb_depois = catalogo['memoria_mb']
+    logger.info(f"Memória do catálogo: {mb_antes:.1f} MB -> {mb_depois:.1f} MB")
+    
+    with store['lock']:
+        # Fotos gravadas durante a carga podem não estar no resultado do Oracle
+        fotos, store['fotos_na_carga'] = store['fotos_na_carga'], None
+        if fotos:
+            catalogo = _patch_photos(catalogo, fotos) or catalogo
+        anterior = store['catalogo']
+        catalogo['versao'] = (anterior['versao'] + 1) if anterior else 1
+        
+        store['catalogo'] = catalogo
+        store['hashes'] = hashes
+        store['atualizado_em'] = time.time()
+        store['carregado_em'] = store['atualizado_em']
+        store['duracao'] = store['atualizado_em'] - inicio
+        store['origem'] = 'oracle'
+    
+    save_catalog_snapshot(catalogo, hashes, store['carregado_em'])
 
-# --- 4. LIMPEZA DE TEXTO OTIMIZADA ---
-def clean_text(text):
-    """Limpa descrição para busca (versão otimizada)"""
-    if not text: 
-        return ""
+
+def invalidate_catalog():
+    """
+    Marca o snapshot como expirado. Com a atualização em segundo plano ativa,
+    dispara a recarga na hora; senão, a próxima leitura fará a atualização.
+    """
+    store = get_catalog_store()
+    store['atualizado_em'] = 0.0
+    if CATALOG_BACKGROUND_REFRESH and store['catalogo'] is not None:
+        _refresh_in_background(store, get_db_engine())
+
+
+def _patch_photos(catalogo, fotos):
+    """
+    Cópia do snapshot com DIRFOTOPROD dos produtos trocado, ou None se
+    nenhum produto do snapshot foi alterado.
     
-    # Remove unidades de medida comuns
-    unidades = r'\b(UN|UND|UNID|CX|CAIXA|KG|KILO|QUILO|LT|LITRO|ML|PCT|PACOTE|FD|FARDO|LATA|VD|VIDRO|GR|GRAMA|MG)\b'
-    text = re.sub(unidades, '', text, flags=re.IGNORECASE)
+    Copia apenas as colunas alteradas, para não modificar as tabelas que
+    outras sessões estão lendo.
+    """
+    produtos = catalogo['produtos']
+    novos_caminhos = produtos['CODPROD'].map(pd.Series(fotos, dtype=object))
+    linhas = novos_caminhos.notna().to_numpy()
+    if not linhas.any():
+        return None
     
-    # Remove padrões tipo "12X500ML" ou "C/24"
-    text = re.sub(r'\b\d+[X|x|C|c|/]\d*\w*\b', '', text)
+    novos_produtos = produtos.copy(deep=False)
+    dirfotoprod = novos_produtos['DIRFOTOPROD'].astype(object)
+    dirfotoprod[linhas] = novos_caminhos[linhas]
+    novos_produtos['DIRFOTOPROD'] = dirfotoprod
+    novos_produtos['STATUS_FOTO'] = pd.Categorical(_status_foto(dirfotoprod))
     
-    # Remove números com unidades no final (ex: "500ML", "2L")
-    text = re.sub(r'\b\d+\s*(ML|L|G|KG|MG)\b', '', text, flags=re.IGNORECASE)
+    return {
+        **catalogo,
+        'produtos': novos_produtos,
+        'versao': catalogo['versao'] + 1
+    }
+
+
+def patch_catalog_photos(fotos):
+    """
+    Atualiza DIRFOTOPROD dos produtos direto no snapshot, sem recarregar o
+    catálogo. Como o produto tem uma única linha na tabela de produtos,
+    todas as filiais passam a enxergar a nova foto.
     
-    # Remove caracteres especiais mas mantém acentos
-    text = re.sub(r'[^\w\sÀ-ÿ]', ' ', text)
+    Args:
+        fotos: {codprod: caminho}
+    """
+    store = get_catalog_store()
+    with store['lock']:
+        if not fotos:
+            return
+        # Carga em andamento: a foto é reaplicada no snapshot novo
+        if store['fotos_na_carga'] is not None:
+            store['fotos_na_carga'].update(fotos)
+        
+        if store['catalogo'] is None:
+            return
+        catalogo = _patch_photos(store['catalogo'], fotos)
+        if catalogo is None:
+            return
+        store['catalogo'] = catalogo
+    
+    logger.info(f"Snapshot atualizado para {len(fotos)} produtos")
+
+
+# ============================================
+# SNAPSHOT DO CATÁLOGO EM DISCO
+# ============================================
+
+# Diretório do snapshot (vazio desativa); Parquet quando pyarrow está instalado
+CATALOG_SNAPSHOT_DIR = os.getenv("CATALOG_SNAPSHOT_DIR", "cache")
+
+try:
+    import pyarrow  # noqa: F401
+    SNAPSHOT_FORMAT = "parquet"
+except ImportError:
+    SNAPSHOT_FORMAT = "pickle"
+
+
+def _snapshot_path(nome, token, formato=None):
+    return os.path.join(CATALOG_SNAPSHOT_DIR, f"{nome}_{token}.{formato or SNAPSHOT_FORMAT}")
+
+
+def _index_arrays(catalogo):
+    """
+    Arrays dos índices de busca, para gravar junto com o snapshot.
+    Os dicionários (EAN exato, vocabulário de trigramas) são remontados na
+    leitura a partir dos arrays, o que é bem mais rápido que refazer os índices.
+    """
+    ean = catalogo['ean_index']
+    arrays = {
+        'ean_eans': ean['eans'],
+        'ean_inicio_cods': ean['inicio_cods'],
+        'ean_codprods': ean['codprods']
+    }
+    for chave, valor in catalogo['desc_index'].items():
+        arrays[f'desc_{chave}'] = valor
+    for col, indice in catalogo['trigram_index'].items():
+        # A posição no array é o id do trigrama
+        arrays[f'trigram_{col}_vocabulario'] = np.array(list(indice['vocabulario']), dtype=str)
+        for chave in ('inicio', 'posicoes', 'qtd'):
+            arrays[f'trigram_{col}_{chave}'] = indice[chave]
+    return arrays
+
+
+def _indices_from_arrays(arrays):
+    """Remonta os índices de busca gravados por _index_arrays"""
+    trigram_index = {}
+    for col in TRIGRAM_COLUMNS:
+        vocabulario = arrays[f'trigram_{col}_vocabulario'].tolist()
+        trigram_index[col] = {
+            'vocabulario': {trigrama: i for i, trigrama in enumerate(vocabulario)},
+            **{chave: arrays[f'trigram_{col}_{chave}'] for chave in ('inicio', 'posicoes', 'qtd')}
+        }
+    
+    return {
+        'ean_index': _ean_index(
+            arrays['ean_eans'], arrays['ean_inicio_cods'], arrays['ean_codprods']
+        ),
+        'desc_index': {
+            chave: arrays[f'desc_{chave}']
+            for chave in ('tokens', 'inicio', 'posicoes', 'qtd_tokens')
+        },
+        'trigram_index': trigram_index
+    }
+
+
+def save_catalog_snapshot(catalogo, hashes, salvo_em):
+    """
+    Grava produtos, estoque e hashes do catálogo em disco.
+    
+    Cada gravação usa um token próprio nos nomes dos arquivos e o meta.json
+    só aponta para ele no final, então uma leitura nunca mistura versões.
+    Os índices de busca vão em um .npz ao lado das tabelas.
+    """
+    if not CATALOG_SNAPSHOT_DIR:
+        return
+    
+    try:
+        os.makedirs(CATALOG_SNAPSHOT_DIR, exist_ok=True)
+        token = f"{int(salvo_em * 1000)}"
+        tabelas = {
+            'produtos': catalogo['produtos'],
+            'estoque': catalogo['estoque'],
+            'hashes': hashes
+        }
+        for nome, tabela in tabelas.items():
+            if SNAPSHOT_FORMAT == "parquet":
+                tabela.to_parquet(_snapshot_path(nome, token), index=False)
+            else:
+                tabela.to_pickle(_snapshot_path(nome, token))
+        np.savez(_snapshot_path('indices', token, 'npz'), **_index_arrays(catalogo))
+        
+        meta_path = os.path.join(CATALOG_SNAPSHOT_DIR, "meta.json")
+        with open(meta_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({'token': token, 'formato': SNAPSHOT_FORMAT, 'salvo_em': salvo_em}, f)
+        os.replace(meta_path + ".tmp", meta_path)
+        
+        # Remove snapshots anteriores (a pasta é compartilhada com os outros caches)
+        for arquivo in os.listdir(CATALOG_SNAPSHOT_DIR):
+            anterior = re.fullmatch(
+                r"(produtos|estoque|hashes)_\d+\.(parquet|pickle)|indices_\d+\.npz", arquivo
+            )
+            if anterior and token not in arquivo:
+                os.remove(os.path.join(CATALOG_SNAPSHOT_DIR, arquivo))
+        
+        logger.info(f"Snapshot do catálogo salvo em {CATALOG_SNAPSHOT_DIR} ({SNAPSHOT_FORMAT})")
+    except Exception as e:
+        logger.warning(f"Falha ao salvar snapshot do catálogo: {e}")
+
+
+def load_catalog_snapshot():
+    """
+    Lê o último snapshot salvo em disco.
+    
+    Returns:
+        Tupla (produtos, estoque, hashes, indices, salvo_em) ou None se não
+        houver snapshot; indices é None quando o arquivo deles não pode ser
+        lido (ex.: snapshot gravado por uma versão anterior)
+    """
+    meta_path = os.path.join(CATALOG_SNAPSHOT_DIR or ".", "meta.json")
+    if not CATALOG_SNAPSHOT_DIR or not os.path.exists(meta_path):
+        return None
+    
+    try:
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta['formato'] != SNAPSHOT_FORMAT:
+            return None
+        
+        leitor = pd.read_parquet if SNAPSHOT_FORMAT == "parquet" else pd.read_pickle
+        produtos, estoque, hashes = (
+            leitor(_snapshot_path(nome, meta['token']))
+            for nome in ('produtos', 'estoque', 'hashes')
+        )
+    except Exception as e:
+        logger.warning(f"Snapshot do catálogo ignorado: {e}")
+        return None
+    
+    try:
+        with np.load(_snapshot_path('indices', meta['token'], 'npz')) as arrays:
+            indices = _indices_from_arrays(arrays)
+    except Exception as e:
+        logger.warning(f"Índices do snapshot ignorados, serão recalculados: {e}")
+        indices = None
+    return produtos, estoque, hashes, indices, meta['salvo_em']
+
+
+def restore_catalog_snapshot(store):
+    """
+    Carrega o snapshot do disco no store (sem consultar o Oracle).
+    
+    A leitura roda fora do store['lock']; só a troca da referência é feita
+    com ele. Quem chama deve segurar store['lock_carga'].
+    """
+    inicio = time.time()
+    snapshot = load_catalog_snapshot()
+    if snapshot is None:
+        return False
+    
+    produtos, estoque, hashes, indices, salvo_em = snapshot
+    # DIAS_SEM_VENDA gravado é da data do snapshot
+    estoque = _recalcular_dias_sem_venda(estoque)
+    catalogo = build_catalog(produtos, estoque, versao=1, indices=indices)
+    
+    with store['lock']:
+        store['catalogo'] = catalogo
+        store['hashes'] = hashes
+        store['carregado_em'] = salvo_em
+        store['origem'] = 'disco'
+    
+    idade = (time.time() - salvo_em) / 60
+    logger.info(
+        f"Snapshot do disco carregado em {time.time() - inicio:.2f}s "
+        f"({len(produtos)} produtos, {idade:.0f} min de idade)"
+    )
+    return True
+
+
+# Atualização periódica em segundo plano (stale-while-revalidate)
+CATALOG_BACKGROUND_REFRESH = os.getenv("CATALOG_BACKGROUND_REFRESH", "1") == "1"
+
+
+def _run_refresh(store, engine):
+    """Executa uma atualização fora do fluxo da interface, registrando erros no store"""
+    with store['lock_carga']:
+        try:
+            refresh_catalog(store, engine=engine)
+            store['erro'] = None
+        except Exception as e:
+            store['erro'] = str(e)
+            store['atualizado_em'] = time.time()
+            logger.error(f"Erro SQL (atualização em segundo plano): {e}")
+        finally:
+            store['atualizando'] = False
+
+
+def _refresh_in_background(store, engine):
+    """Dispara uma atualização em thread, mantendo o snapshot atual em uso"""
+    if store['atualizando']:
+        return
+    store['atualizando'] = True
+    threading.Thread(
+        target=_run_refresh, args=(store, engine), name="catalog-refresh", daemon=True
+    ).start()
+
+
+@st.cache_resource
+def start_catalog_refresher():
+    """
+    Inicia (uma vez por processo) a thread que recarrega o catálogo a cada
+    CATALOG_TTL segundos. As sessões só leem o snapshot já carregado e a
+    troca pela versão nova é uma única atribuição no store.
+    """
+    store = get_catalog_store()
+    engine = get_db_engine()
+    
+    def agendador():
+        while True:
+            time.sleep(5)
+            expirado = time.time() - store['atualizado_em'] > CATALOG_TTL
+            if expirado and store['catalogo'] is not None and not store['atualizando']:
+                store['atualizando'] = True
+                _run_refresh(store, engine)
+    
+    thread = threading.Thread(target=agendador, name="catalog-refresher", daemon=True)
+    thread.start()
+    logger.info(f"Atualização automática do catálogo a cada {CATALOG_TTL}s")
+    return thread
+
+
+def fetch_product_data():
+    """
+    Busca dados do Oracle COM suporte a múltiplos EANs e atualização incremental.
+    
+    Returns:
+        Snapshot do catálogo (dicionário com as tabelas 'produtos' e 'estoque',
+        ver build_catalog) ou None se nada pôde ser carregado
+    """
+    store = get_catalog_store()
+    
+    # Partida a frio: serve o snapshot do disco (não depende do Oracle)
+    restaurado = False
+    if store['catalogo'] is None:
+        with store['lock_carga']:
+            restaurado = store['catalogo'] is None and restore_catalog_snapshot(store)
+    
+    try:
+        # Criar a engine pode falhar (ex.: .env incompleto): fica dentro do try
+        if CATALOG_BACKGROUND_REFRESH:
+            start_catalog_refresher()
+        if restaurado:
+            _refresh_in_background(store, get_db_engine())
+        
+        # Com o agendador ativo, só a primeira carga (sem snapshot) bloqueia a sessão
+        carga_na_sessao = store['catalogo'] is None or not CATALOG_BACKGROUND_REFRESH
+        
+        if carga_na_sessao and not store['atualizando']:
+            with store['lock_carga']:
+                if time.time() - store['atualizado_em'] > CATALOG_TTL:
+                    refresh_catalog(store)
+                    store['erro'] = None
+    except Exception as e:
+        st.error(f"❌ Erro ao buscar dados: {e}")
+        logger.error(f"Erro SQL: {e}")
+        if store['catalogo'] is not None:
+            # Continua servindo o último catálogo; nova tentativa após o TTL
+            store['erro'] = str(e)
+            store['atualizado_em'] = time.time()
+    
+    if store['erro'] and store['catalogo'] is not None:
+        carregado = datetime.fromtimestamp(store['carregado_em']).strftime('%d/%m/%Y %H:%M')
+        st.warning(f"⚠️ Oracle indisponível. Exibindo dados carregados em {carregado}.")
+    
+    return store['catalogo']
+
+
+def build_catalog_view(catalogo, posicoes, por_produto=False, similaridade=None):
+    """
+    Monta a visão exibida na tabela a partir das linhas de estoque filtradas.
+    
+    Args:
+        catalogo: Snapshot retornado por fetch_product_data
+        posicoes: Posições (iloc) na tabela de estoque
+        por_produto: False = uma linha por produto/filial;
+                     True = uma linha por produto com o estoque de cada filial
+                     em colunas QTEST_<filial>
+        similaridade: Similaridade por produto (busca aproximada), exibida
+                      na coluna SIMILARIDADE
+    """
+    produtos = catalogo['produtos']
+    estoque = catalogo['estoque'].iloc[posicoes].reset_index(drop=True)
+    pos_produto = catalogo['pos_produto'][posicoes]
+    
+    if not por_produto:
+        prod = produtos.iloc[pos_produto].drop(columns='CODPROD').reset_index(drop=True)
+        view = pd.concat([estoque, prod], axis=1)[CATALOG_COLUMNS]
+        if similaridade is not None:
+            view.insert(0, 'SIMILARIDADE', similaridade[pos_produto])
+        return view
+    
+    por_filial = estoque.pivot(index='CODPROD', columns='CODFILIAL', values='QTEST')
+    por_filial.columns = [f"QTEST_{filial}" for filial in por_filial.columns]
+    
+    resumo = estoque.groupby('CODPROD').agg(
+        QTEST=('QTEST', 'sum'),
+        DTULTSAIDA=('DTULTSAIDA', 'max'),
+        DIAS_SEM_VENDA=('DIAS_SEM_VENDA', 'min')
+    )
+    
+    # pd.unique mantém a ordem das posições (ex.: relevância da busca)
+    posicoes_prod = pd.unique(pos_produto)
+    view = (
+        produtos.iloc[posicoes_prod]
+        .join(resumo, on='CODPROD')
+        .join(por_filial, on='CODPROD')
+        .reset_index(drop=True)
+    )
+    if similaridade is not None:
+        view.insert(0, 'SIMILARIDADE', similaridade[posicoes_prod])
+    return view
+
+# ============================================
+# MOTOR DE FILTROS (MÁSCARA ÚNICA)
+# ============================================
+
+def build_filter_spec(cod="", ean="", desc="", filiais=None, status=None,
+                      deptos=None, dias_min=0, foto="Todos", exclusao="Todos",
+                      aproximada=False, fornecedor=False):
+    """Agrupa o estado dos filtros da sidebar em um dicionário"""
+    return {
+        'cod': (cod or "").strip(),
+        'ean': (ean or "").strip(),
+        'desc': desc or "",
+        'aproximada': aproximada,
+        'fornecedor': fornecedor,
+        'filiais': list(filiais or []),
+        'status': list(status or []),
+        'deptos': list(deptos or []),
+        'dias_min': dias_min,
+        'foto': foto,
+        'exclusao': exclusao
+    }
+
+
+def compute_filter_positions(catalogo, spec):
+    """
+    Avalia todos os filtros em uma única máscara booleana.
+    
+    Os predicados de produto rodam sobre a tabela de produtos (uma linha por
+    CODPROD) e os de estoque sobre a tabela de estoque. Os baratos e
+    seletivos (código, categorias, números) rodam primeiro sobre as colunas
+    inteiras; os caros (EAN, descrição) rodam só sobre os produtos que
+    sobreviveram.
+    
+    Returns:
+        Tupla (posições, similaridade): posições (iloc) das linhas de estoque
+        que atendem ao filtro, ordenadas pela relevância quando há busca por
+        descrição; similaridade por produto na busca aproximada (senão None)
+    """
+    produtos = catalogo['produtos']
+    estoque = catalogo['estoque']
+    pos_produto = catalogo['pos_produto']
+    
+    # 1. Predicados de produto
+    mask_prod = np.ones(len(produtos), dtype=bool)
+    
+    if spec['cod']:
+        # Equivalente a CODPROD.astype(str) == cod, sem converter a coluna
+        cod = spec['cod']
+        if cod.isdigit() and str(int(cod)) == cod:
+            mask_prod &= produtos['CODPROD'].to_numpy() == int(cod)
+        else:
+            mask_prod[:] = False
+    
+    if spec['status']:
+        mask_prod &= produtos['STATUS'].isin(spec['status']).to_numpy()
+    
+    if spec['deptos']:
+        mask_prod &= produtos['DEPARTAMENTO'].isin(spec['deptos']).to_numpy()
+    
+    if spec['foto'] == "✅ Com Foto":
+        mask_prod &= (produtos['STATUS_FOTO'] == '✅').to_numpy()
+    elif spec['foto'] == "❌ Sem Foto":
+        mask_prod &= (produtos['STATUS_FOTO'] == '❌').to_numpy()
+    
+    if spec['exclusao'] == "Apenas Ativos":
+        mask_prod &= produtos['DTEXCLUSAO'].isna().to_numpy()
+    elif spec['exclusao'] == "Apenas Excluídos":
+        mask_prod &= produtos['DTEXCLUSAO'].notna().to_numpy()
+    
+    # 2. Predicados de estoque
+    mask = mask_prod[pos_produto]
+    
+    if spec['filiais']:
+        mask &= estoque['CODFILIAL'].isin(spec['filiais']).to_numpy()
+    
+    mask &= (estoque['DIAS_SEM_VENDA'] >= spec['dias_min']).to_numpy()
+    
+    # 3. Predicados caros, só sobre os produtos que ainda têm linhas
+    relevancia = similaridade = None
+    if (spec['ean'] or spec['desc']) and mask.any():
+        candidatos = np.unique(pos_produto[mask])
+        
+        # FILTRO EAN - Busca em todos os EANs via índice
+        if spec['ean']:
+            codprods_ean = lookup_ean(catalogo['ean_index'], spec['ean'])
+            candidatos = candidatos[
+                np.isin(produtos['CODPROD'].to_numpy()[candidatos], codprods_ean)
+            ]
+        
+        # FILTRO DESCRIÇÃO - Aproximada: top-k por trigramas
+        if spec['desc'] and spec['aproximada']:
+            candidatos, similaridade = fuzzy_search(
+                catalogo, spec['desc'], candidatos, incluir_fornecedor=spec['fornecedor']
+            )
+            relevancia = similaridade
+            encontrados = None
+        # Índice de palavras (sem acento, qualquer ordem, prefixo)
+        else:
+            encontrados = search_descriptions(catalogo['desc_index'], spec['desc']) if spec['desc'] else None
+        
+        if encontrados is not None:
+            posicoes_desc, pontos = encontrados
+            candidatos = candidatos[np.isin(candidatos, posicoes_desc)]
+            relevancia = np.zeros(len(produtos), dtype=np.float32)
+            relevancia[posicoes_desc] = pontos
+        elif spec['desc'] and not spec['aproximada'] and len(candidatos):
+            # Busca sem palavras indexáveis (ex.: só "2L"): trecho literal
+            descricoes = produtos['DESCRICAO'].iloc[candidatos]
+            candidatos = candidatos[
+                descricoes.str.contains(spec['desc'], case=False, na=False, regex=False).to_numpy()
+            ]
+        
+        mask_prod = np.zeros(len(produtos), dtype=bool)
+        mask_prod[candidatos] = True
+        mask &= mask_prod[pos_produto]
+    
+    posicoes = np.flatnonzero(mask)
+    if relevancia is not None:
+        # Mais relevantes primeiro (estável: mantém a ordem por produto/filial)
+        posicoes = posicoes[np.argsort(-relevancia[pos_produto[posicoes]], kind='stable')]
+    return posicoes, similaridade
+
+
+# Facetas da sidebar: (nome no spec, tabela, coluna)
+FACET_COLUMNS = [
+    ('filiais', 'estoque', 'CODFILIAL'),
+    ('status', 'produtos', 'STATUS'),
+    ('deptos', 'produtos', 'DEPARTAMENTO')
+]
+
+
+def build_facets(produtos, estoque):
+    """
+    Opções dos filtros da sidebar, calculadas uma vez por versão dos dados.
+    
+    Para cada faceta guarda também o código do grupo de cada linha (-1 para
+    vazio), usado para contar as opções com np.bincount sem reagrupar.
+    """
+    tabelas = {'produtos': produtos, 'estoque': estoque}
+    facetas = {}
+    for nome, tabela, coluna in FACET_COLUMNS:
+        codigos, opcoes = pd.factorize(tabelas[tabela][coluna], sort=True)
+        facetas[nome] = {
+            'tabela': tabela,
+            'opcoes': opcoes.tolist(),
+            'codigos': codigos
+        }
+    
+    dias = estoque['DIAS_SEM_VENDA']
+    facetas['max_dias'] = int(dias.max()) if not dias.isnull().all() else 0
+    return facetas
+
+
+def compute_facet_counts(catalogo, spec, posicoes, por_produto=False):
+    """
+    Quantas linhas da visão cada opção das facetas teria no filtro atual.
+    
+    A seleção da própria faceta não entra na contagem dela (as demais opções
+    continuam mostrando quanto acrescentariam); sem seleção na faceta, as
+    posições já filtradas são reaproveitadas.
+    
+    Returns:
+        {faceta: {opção: contagem}}
+    """
+    pos_produto = catalogo['pos_produto']
+    contagens = {}
+    for nome, _, _ in FACET_COLUMNS:
+        faceta = catalogo['facetas'][nome]
+        pos = posicoes
+        if spec[nome]:
+            pos, _ = compute_filter_positions(catalogo, {**spec, nome: []})
+        
+        if faceta['tabela'] == 'estoque':
+            grupos = faceta['codigos'][pos]
+        elif por_produto:
+            grupos = faceta['codigos'][np.unique(pos_produto[pos])]
+        else:
+            grupos = faceta['codigos'][pos_produto[pos]]
+        
+        contagem = np.bincount(grupos[grupos >= 0], minlength=len(faceta['opcoes']))
+        contagens[nome] = dict(zip(faceta['opcoes'], contagem.tolist()))
+    return contagens
+
+
+def facet_caption(contagem, selecionados, limite=4):
+    """Legenda da faceta: contagem das opções escolhidas ou das maiores"""
+    if selecionados:
+        itens = [(opcao, contagem.get(opcao, 0)) for opcao in selecionados]
+    else:
+        itens = sorted(contagem.items(), key=lambda item: -item[1])[:limite]
+    return " · ".join(f"{opcao} ({qtd:,})" for opcao, qtd in itens if qtd or selecionados)
+
+
+# ============================================
+# CONSULTA DIRETA NO ORACLE (PUSHDOWN)
+# ============================================
+
+MEMORY_MODE = "Catálogo em memória"
+PUSHDOWN_MODE = "Consulta direta (Oracle)"
+QUERY_MODES = [MEMORY_MODE, PUSHDOWN_MODE]
+# Modo inicial da sidebar: "memoria" ou "oracle"
+QUERY_MODE = os.getenv("QUERY_MODE", "memoria").lower()
+# Máximo de linhas (produto + filial) trazidas por consulta direta
+PUSHDOWN_MAX_ROWS = int(os.getenv("PUSHDOWN_MAX_ROWS", "5000"))
+PUSHDOWN_CACHE_TTL = 60
+
+# Remove acentos no Oracle (equivalente ao normalize_description)
+ORACLE_SEM_ACENTO = "TRANSLATE(UPPER({coluna}), 'ÁÀÂÃÄÉÈÊËÍÌÎÏÓÒÔÕÖÚÙÛÜÇÑ', 'AAAAAEEEEIIIIOOOOOUUUUCN')"
+
+
+def _like_contem(texto):
+    """Padrão LIKE '%texto%' com os curingas escapados (usar com ESCAPE '\\')"""
+    texto = texto.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f"%{texto}%"
+
+
+def _fuzzy_fragments(busca):
+    """
+    Trigramas internos das palavras da busca com 3 ou mais caracteres
+    (trechos menores casam com quase todo o catálogo).
+    """
+    texto = unicodedata.normalize('NFKD', str(busca))
+    texto = "".join(c for c in texto if not unicodedata.combining(c)).upper()
+    trechos = set()
+    for palavra in re.sub(r'[^A-Z0-9]+', ' ', texto).split():
+        trechos.update(palavra[i:i + 3] for i in range(len(palavra) - 2))
+    return sorted(trechos)
+
+
+def build_pushdown_filter(spec):
+    """
+    Traduz os filtros da sidebar em condições SQL com bind variables.
+    
+    As condições selecionam um superconjunto do resultado do filtro em
+    memória (ex.: palavra da descrição em qualquer posição, não só no início
+    de palavra); o refinamento exato é feito por compute_filter_positions
+    sobre as poucas linhas retornadas.
+    
+    Na busca aproximada as linhas vêm ordenadas pela quantidade de
+    trigramas da busca encontrados, para que o corte de PUSHDOWN_MAX_ROWS
+    fique com as mais parecidas.
+    
+    Returns:
+        Tupla (condições "AND ..." para o filtro_extra, binds, ORDER BY)
+    """
+    condicoes = []
+    binds = {}
+    ordem = "V.CODPROD"
+    
+    if spec['cod']:
+        cod = spec['cod']
+        if cod.isdigit() and str(int(cod)) == cod:
+            condicoes.append("P.CODPROD = :cod")
+            binds['cod'] = int(cod)
+        else:
+            condicoes.append("1 = 0")
+    
+    if spec['ean']:
+        condicoes.append("""EXISTS (
+            SELECT 1 FROM PCEMBALAGEM X
+            WHERE X.CODPROD = P.CODPROD
+              AND X.DTINATIVO IS NULL
+              AND LENGTH(TRIM(X.CODAUXILIAR)) >= 8
+              AND TO_CHAR(X.CODAUXILIAR) LIKE :ean ESCAPE '\\'
+        )""")
+        binds['ean'] = _like_contem(spec['ean'])
+    
+    trigramas = _fuzzy_fragments(spec['desc']) if spec['desc'] and spec['aproximada'] else []
+    if trigramas:
+        # Algum trigrama em comum com a descrição (ou o fornecedor); as linhas
+        # com mais trigramas em comum vêm primeiro
+        colunas = ["DESCRICAO"] + (["FORNECEDOR"] if spec['fornecedor'] else [])
+        origem = {"DESCRICAO": "P.DESCRICAO", "FORNECEDOR": "F.FORNECEDOR"}
+        
+        def casa(i, visao=False):
+            return " OR ".join(
+                f"{ORACLE_SEM_ACENTO.format(coluna=f'V.{coluna}' if visao else origem[coluna])} "
+                f"LIKE :t{i} ESCAPE '\\'"
+                for coluna in colunas
+            )
+        
+        for i, trecho in enumerate(trigramas):
+            binds[f"t{i}"] = _like_contem(trecho)
+        condicoes.append(f"({' OR '.join(casa(i) for i in range(len(trigramas)))})")
+        pontos = " + ".join(
+            f"CASE WHEN {casa(i, visao=True)} THEN 1 ELSE 0 END" for i in range(len(trigramas))
+        )
+        # Desempate como na similaridade: textos mais curtos primeiro
+        ordem = f"({pontos}) DESC, LENGTH(V.DESCRICAO), V.CODPROD"
+    elif spec['desc']:
+        # Também a busca aproximada sem palavras de 3+ letras (ex.: "2 l")
+        palavras = list(dict.fromkeys(normalize_description(spec['desc']).upper().split()))
+        if palavras:
+            coluna = ORACLE_SEM_ACENTO.format(coluna="P.DESCRICAO")
+            for i, palavra in enumerate(palavras):
+                condicoes.append(f"{coluna} LIKE :d{i} ESCAPE '\\'")
+                binds[f"d{i}"] = _like_contem(palavra)
+        else:
+            # Mesmo trecho literal do filtro em memória
+            condicoes.append("UPPER(P.DESCRICAO) LIKE :desc ESCAPE '\\'")
+            binds['desc'] = _like_contem(spec['desc'].upper())
+    
+    if spec['filiais']:
+        nomes = [f"fil{i}" for i in range(len(spec['filiais']))]
+        condicoes.append(f"E.CODFILIAL IN ({', '.join(':' + nome for nome in nomes)})")
+        binds.update(zip(nomes, (int(filial) for filial in spec['filiais'])))
+    
+    if set(spec['status']) == {'Fora de Linha'}:
+        condicoes.append("P.OBS2 = 'FL'")
+    elif set(spec['status']) == {'Ativo'}:
+        condicoes.append("(P.OBS2 IS NULL OR P.OBS2 <> 'FL')")
+    
+    if spec['deptos']:
+        nomes = [f"dep{i}" for i in range(len(spec['deptos']))]
+        condicoes.append(f"D.DESCRICAO IN ({', '.join(':' + nome for nome in nomes)})")
+        binds.update(zip(nomes, spec['deptos']))
+    
+    if spec['dias_min'] > 0:
+        condicoes.append("E.DTULTSAIDA <= SYSDATE - :dias_min")
+        binds['dias_min'] = int(spec['dias_min'])
+    
+    if spec['foto'] == "✅ Com Foto":
+        condicoes.append("P.DIRFOTOPROD IS NOT NULL")
+    elif spec['foto'] == "❌ Sem Foto":
+        condicoes.append("P.DIRFOTOPROD IS NULL")
+    
+    if spec['exclusao'] == "Apenas Ativos":
+        condicoes.append("P.DTEXCLUSAO IS NULL")
+    elif spec['exclusao'] == "Apenas Excluídos":
+        condicoes.append("P.DTEXCLUSAO IS NOT NULL")
+    
+    return "\n    ".join(f"AND {condicao}" for condicao in condicoes), binds, ordem
+
+
+@st.cache_data(ttl=PUSHDOWN_CACHE_TTL, max_entries=50, show_spinner=False)
+def query_catalog(spec):
+    """
+    Consulta direta: busca no Oracle só as linhas que atendem ao filtro e
+    monta com elas um catálogo pequeno, no mesmo formato do build_catalog.
+    
+    Returns:
+        Tupla (catálogo ou None se nada foi encontrado, True se o resultado
+        passou de PUSHDOWN_MAX_ROWS e foi cortado)
+    """
+    filtro_extra, binds, ordem = build_pushdown_filter(spec)
+    query, params = build_product_query(filtro_extra=filtro_extra, ordem=ordem)
+    query += "\n    FETCH FIRST :max_linhas ROWS ONLY"
+    
+    inicio = time.time()
+    with get_db_engine().connect() as connection:
+        df = read_oracle_frame(
+            connection, query, {**params, **binds, 'max_linhas': PUSHDOWN_MAX_ROWS + 1}
+        )
+    df.columns = df.columns.str.upper()
+    logger.info(f"Consulta direta: {len(df):,} linhas em {time.time() - inicio:.2f}s")
+    
+    truncado = len(df) > PUSHDOWN_MAX_ROWS
+    if df.empty:
+        return None, False
+    
+    # O catálogo exige as linhas em ordem de CODPROD (ver build_catalog)
+    df = df.iloc[:PUSHDOWN_MAX_ROWS].sort_values('CODPROD', kind='stable')
+    df = _recalcular_dias_sem_venda(df.reset_index(drop=True))
+    produtos, estoque = split_catalog(df)
+    return build_catalog(produtos, estoque, versao=int(inicio)), truncado
+
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def _query_facet_options():
+    """Opções das facetas lidas do Oracle (consulta direta sem catálogo carregado)"""
+    with get_db_engine().connect() as connection:
+        deptos = pd.read_sql(
+            text("SELECT DESCRICAO FROM PCDEPTO WHERE DESCRICAO IS NOT NULL ORDER BY DESCRICAO"),
+            connection
+        )
+        binds = {f"filial{i}": filial for i, filial in enumerate(CATALOG_FILIAIS)}
+        dias = pd.read_sql(
+            text(
+                "SELECT MAX(TRUNC(SYSDATE - DTULTSAIDA)) AS DIAS FROM PCEST "
+                f"WHERE CODFILIAL IN ({', '.join(':' + nome for nome in binds)})"
+            ),
+            connection, params=binds
+        )
+    maior = dias.iloc[0, 0] if not dias.empty else None
+    return _pushdown_facet_options(
+        deptos.iloc[:, 0].drop_duplicates().tolist(),
+        int(maior) if pd.notna(maior) else 0
+    )
+
+
+def _pushdown_facet_options(deptos, max_dias):
+    """Facetas da consulta direta: filiais da configuração e status fixos"""
+    return {
+        'filiais': {'opcoes': sorted(CATALOG_FILIAIS)},
+        'status': {'opcoes': ['Ativo', 'Fora de Linha']},
+        'deptos': {'opcoes': deptos},
+        'max_dias': max_dias
+    }
+
+
+def pushdown_facets():
+    """
+    Opções dos filtros da sidebar no modo de consulta direta: as do catálogo
+    em memória, se outro usuário já o carregou, ou lidas do Oracle.
+    """
+    catalogo = get_catalog_store()['catalogo']
+    if catalogo is not None:
+        return catalogo['facetas']
+    try:
+        return _query_facet_options()
+    except Exception as e:
+        # Oracle fora do ar: a própria consulta direta mostrará o erro
+        logger.error(f"Erro ao ler as opções dos filtros: {e}")
+        return _pushdown_facet_options([], 0)
+
+
+# ============================================
+# PAGINAÇÃO DA TABELA
+# ============================================
+
+TABLE_COLUMNS = [
+    "STATUS_FOTO", "CODFILIAL", "CODPROD", "DESCRICAO", 
+    "EAN", "QTEST", "DIAS_SEM_VENDA", "STATUS", "DTEXCLUSAO"
+]
+
+PAGE_SIZE_OPTIONS = [50, 100, 250, 500]
+
+
+def table_columns(df):
+    """
+    Colunas exibidas na tabela (na visão por produto, uma coluna de estoque
+    por filial; na busca aproximada, a similaridade primeiro)
+    """
+    similaridade = ["SIMILARIDADE"] if 'SIMILARIDADE' in df.columns else []
+    if 'CODFILIAL' in df.columns:
+        return similaridade + TABLE_COLUMNS
+    
+    colunas_filial = sorted(col for col in df.columns if col.startswith("QTEST_"))
+    colunas = [col for col in TABLE_COLUMNS if col != "CODFILIAL"]
+    posicao = colunas.index("QTEST") + 1
+    return similaridade + colunas[:posicao] + colunas_filial + colunas[posicao:]
+
+
+def get_page(df, page, page_size, sort_col=None, ascending=True):
+    """
+    Retorna apenas a página solicitada do resultado filtrado.
+    
+    A ordenação é feita sobre as posições (argsort estável), então só as
+    linhas da página são copiadas e enviadas ao navegador.
+    
+    Returns:
+        Tupla (DataFrame da página, total de páginas)
+    """
+    total_paginas = max(1, -(-len(df) // page_size))
+    page = min(max(1, page), total_paginas)
+    
+    if sort_col:
+        ordem = (
+            df[sort_col]
+            .reset_index(drop=True)
+            .sort_values(ascending=ascending, kind='stable', na_position='last')
+            .index.to_numpy()
+        )
+    else:
+        ordem = np.arange(len(df))
+    
+    inicio = (page - 1) * page_size
+    return df.iloc[ordem[inicio:inicio + page_size]], total_paginas
+
+
+def _mudar_pagina(delta, total_paginas):
+    """Callback dos botões de navegação"""
+    atual = st.session_state.get('pagina_tabela', 1)
+    st.session_state.pagina_tabela = min(max(1, atual + delta), total_paginas)
+
+
+# ============================================
+# EXPORTAÇÃO (SOB DEMANDA)
+# ============================================
+
+# Formato -> (extensão, mime); Parquet só com pyarrow instalado
+EXPORT_FORMATS = {
+    'Excel': ('xlsx', "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    'CSV': ('csv', "text/csv"),
+}
+if SNAPSHOT_FORMAT == "parquet":
+    EXPORT_FORMATS['Parquet'] = ('parquet', "application/vnd.apache.parquet")
+
+# Linhas convertidas por vez na gravação do Excel
+EXPORT_CHUNK_ROWS = 5000
+
+
+def _export_excel(df):
+    """
+    Gera o .xlsx com XlsxWriter em modo constant_memory: as linhas são
+    gravadas em sequência e descarregadas em arquivo temporário, sem manter
+    a planilha inteira em memória. A conversão para valores Python também
+    é feita em blocos de EXPORT_CHUNK_ROWS linhas.
+    """
+    import xlsxwriter
+    
+    saida = BytesIO()
+    workbook = xlsxwriter.Workbook(saida, {
+        'constant_memory': True,
+        'default_date_format': 'dd/mm/yyyy'
+    })
+    worksheet = workbook.add_worksheet('Analise_Produtos')
+    worksheet.write_row(0, 0, [str(col) for col in df.columns], workbook.add_format({'bold': True}))
+    
+    linha = 1
+    for inicio in range(0, len(df), EXPORT_CHUNK_ROWS):
+        bloco = df.iloc[inicio:inicio + EXPORT_CHUNK_ROWS]
+        valores = bloco.astype(object).where(bloco.notna(), None)
+        for registro in valores.itertuples(index=False, name=None):
+            worksheet.write_row(linha, 0, registro)
+            linha += 1
+    
+    workbook.close()
+    return saida.getvalue()
+
+
+def build_export(df, formato):
+    """Gera os bytes do arquivo de exportação no formato pedido"""
+    inicio = time.time()
+    if formato == 'Excel':
+        dados = _export_excel(df)
+    elif formato == 'CSV':
+        # Separador e decimal no padrão do Excel em português
+        dados = df.to_csv(index=False, sep=';', decimal=',', date_format='%d/%m/%Y').encode('utf-8-sig')
+    else:
+        saida = BytesIO()
+        df.to_parquet(saida, index=False)
+        dados = saida.getvalue()
+    
+    logger.info(f"Exportação {formato}: {len(df):,} linhas, {len(dados) / 1024**2:.1f} MB em {time.time() - inicio:.1f}s")
+    return dados
+
+
+# --- 3. CONTROLE DE COTAS DA API ---
+# Quota global (token bucket) compartilhada por todas as sessões e processos.
+# Cada janela tem (limite, duração em segundos); os tokens são repostos
+# continuamente na taxa limite/duração.
+API_QUOTA_PATH = os.getenv("API_QUOTA_PATH", os.path.join("cache", "api_quota.db"))
+API_QUOTA_WINDOWS = {
+    'hora': (int(os.getenv("API_QUOTA_HOURLY", "100")), 3600),
+    'dia': (int(os.getenv("API_QUOTA_DAILY", "10000")), 86400)
+}
+# Tempo máximo (s) que uma busca aguarda na fila por um token antes de ser recusada
+API_QUOTA_MAX_WAIT = float(os.getenv("API_QUOTA_MAX_WAIT", "5"))
+
+
+def _quota_connect():
+    """Abre o banco da quota em modo autocommit (as transações são explícitas)"""
+    pasta = os.path.dirname(API_QUOTA_PATH)
+    if pasta:
+        os.makedirs(pasta, exist_ok=True)
+    
+    conn = sqlite3.connect(API_QUOTA_PATH, timeout=30, isolation_level=None)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS baldes (
+            janela TEXT PRIMARY KEY,
+            tokens REAL NOT NULL,
+            atualizado_em REAL NOT NULL
+        )
+    """)
+    return conn
+
+
+def _ler_baldes(conn, agora):
+    """Lê os baldes já com a reposição de tokens até 'agora'"""
+    salvos = {
+        janela: (tokens, atualizado_em)
+        for janela, tokens, atualizado_em in conn.execute("SELECT * FROM baldes")
+    }
+    baldes = {}
+    for janela, (limite, duracao) in API_QUOTA_WINDOWS.items():
+        tokens, atualizado_em = salvos.get(janela, (limite, agora))
+        baldes[janela] = min(limite, tokens + (agora - atualizado_em) * limite / duracao)
+    return baldes
+
+
+def _espera_por_token(baldes):
+    """Segundos até haver pelo menos um token em todas as janelas"""
+    return max(
+        (1 - tokens) * API_QUOTA_WINDOWS[janela][1] / API_QUOTA_WINDOWS[janela][0]
+        for janela, tokens in baldes.items()
+    )
+
+
+def acquire_quota(max_wait=0.0):
+    """
+    Reserva uma busca na quota global.
+    
+    Se não houver token, aguarda na fila até max_wait segundos; se a espera
+    necessária for maior, recusa na hora (sem gastar uma chamada que falharia).
+    
+    Returns:
+        True se a busca foi autorizada
+    """
+    limite_espera = time.time() + max_wait
+    while True:
+        agora = time.time()
+        with closing(_quota_connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            baldes = _ler_baldes(conn, agora)
+            if all(tokens >= 1 for tokens in baldes.values()):
+                conn.executemany(
+                    "INSERT OR REPLACE INTO baldes VALUES (?, ?, ?)",
+                    [(janela, tokens - 1, agora) for janela, tokens in baldes.items()]
+                )
+                conn.execute("COMMIT")
+                return True
+            conn.execute("ROLLBACK")
+        
+        espera = _espera_por_token(baldes)
+        if agora + espera > limite_espera:
+            return False
+        time.sleep(espera)
+
+
+def quota_status():
+    """
+    Situação atual da quota global.
+    
+    Returns:
+        {janela: {'restante', 'limite', 'proximo_em'}} onde 'proximo_em' são
+        os segundos até o próximo token quando a janela está esgotada
+    """
+    try:
+        with closing(_quota_connect()) as conn:
+            baldes = _ler_baldes(conn, time.time())
+    except Exception as e:
+        logger.warning(f"Quota indisponível: {e}")
+        baldes = {janela: limite for janela, (limite, _) in API_QUOTA_WINDOWS.items()}
+    
+    return {
+        janela: {
+            'restante': int(tokens),
+            'limite': API_QUOTA_WINDOWS[janela][0],
+            'proximo_em': max(0.0, _espera_por_token({janela: tokens}))
+        }
+        for janela, tokens in baldes.items()
+    }
+
+
+def check_quota():
+    """Reserva uma busca na quota global do Google (hora e dia)"""
+    if acquire_quota(max_wait=API_QUOTA_MAX_WAIT):
+        st.session_state.api_quota['count'] += 1
+        return True
+    
+    status = quota_status()
+    tempo_restante = int(max(janela['proximo_em'] for janela in status.values()) / 60) + 1
+    st.warning(f"⚠️ Limite de buscas da API atingido. Aguarde {tempo_restante} minutos.")
+    logger.warning("Busca recusada: quota global esgotada")
+    return False
+
+
+# --- 4. LIMPEZA DE TEXTO OTIMIZADA ---
+def clean_text(text):
+    """Limpa descrição para busca (versão otimizada)"""
+    if not text: 
+        return ""
+    
+    # Remove unidades de medida comuns
+    unidades = r'\b(UN|UND|UNID|CX|CAIXA|KG|KILO|QUILO|LT|LITRO|ML|PCT|PACOTE|FD|FARDO|LATA|VD|VIDRO|GR|GRAMA|MG)\b'
+    text = re.sub(unidades, '', text, flags=re.IGNORECASE)
+    
+    # Remove padrões tipo "12X500ML" ou "C/24"
+    text = re.sub(r'\b\d+[X|x|C|c|/]\d*\w*\b', '', text)
+    
+    # Remove números com unidades no final (ex: "500ML", "2L")
+    text = re.sub(r'\b\d+\s*(ML|L|G|KG|MG)\b', '', text, flags=re.IGNORECASE)
+    
+    # Remove caracteres especiais mas mantém acentos
+    text = re.sub(r'[^\w\sÀ-ÿ]', ' ', text)
     
     # Remove espaços duplicados
     return " ".join(text.split()).strip()
 
-# --- 5. BUSCA GOOGLE IMAGENS (COM TRATAMENTO DE ERROS) ---
-def google_image_search_api(query, num_results=4):
+# --- 5. BUSCA GOOGLE IMAGENS (COM TRATAMENTO DE ERROS) ---
+def _google_image_request(query, num_results=4):
+    """
+    Chamada à API Custom Search sem mensagens na tela (usada também pelas
+    threads do lote). Levanta exceção em caso de erro.
+    """
+    api_key = os.getenv("GOOGLE_API_KEY")
+    cse_id = os.getenv("GOOGLE_CSE_ID")
+    
+    if not api_key or not cse_id:
+        raise RuntimeError("API Key ou CSE ID não encontrados")
+
+    url = "https://www.googleapis.com/customsearch/v1"
+    params = {
+        'q': query,
+        'cx': cse_id,
+        'key': api_key,
+        'searchType': 'image',
+        'num': num_results,
+        'fileType': 'jpg,png,jpeg',
+        'gl': 'br',
+        'hl': 'pt',
+        'safe': 'active'
+    }
+    
+    response = requests.get(url, params=params, timeout=10)
+    response.raise_for_status()  # ✅ Verifica status HTTP
+    
+    data = response.json()
+    
+    if 'error' in data:
+        raise ValueError(data['error'].get('message', 'Erro desconhecido'))
+    return data.get('items', [])
+
+
+def google_image_search_api(query, num_results=4):
+    """
+    Consulta a API Custom Search do Google com tratamento completo de erros.
+    Retorna uma lista de dicionários com 'link' e 'thumbnail'.
+    """
+    if not os.getenv("GOOGLE_API_KEY") or not os.getenv("GOOGLE_CSE_ID"):
+        st.error("⚠️ Configuração da API do Google ausente no .env")
+        logger.error("API Key ou CSE ID não encontrados")
+        return []
+
+    try:
+        items = _google_image_request(query, num_results)
+        
+        if items:
+            logger.info(f"Busca bem-sucedida: {len(items)} imagens para '{query}'")
+        else:
+            logger.warning(f"Nenhuma imagem encontrada para: {query}")
+        return items
+            
+    except ValueError as e:
+        st.error(f"❌ Erro da API: {e}")
+        logger.error(f"Erro API Google: {e}")
+        return []
+    except requests.exceptions.Timeout:
+        st.warning("⏱️ Tempo limite esgotado. Tente novamente.")
+        logger.warning(f"Timeout na busca: {query}")
+        return []
+    except requests.exceptions.HTTPError as e:
+        st.error(f"❌ Erro HTTP {e.response.status_code}: {e.response.text}")
+        logger.error(f"HTTP Error: {e}")
+        return []
+    except requests.exceptions.RequestException as e:
+        st.error(f"❌ Erro de conexão: {str(e)}")
+        logger.error(f"Request Error: {e}")
+        return []
+    except Exception as e:
+        st.error(f"❌ Erro inesperado: {e}")
+        logger.error(f"Unexpected error: {e}")
+        return []
+
+# ============================================
+# CACHE PERSISTENTE DE BUSCAS (COMPARTILHADO)
+# ============================================
+
+# Arquivo SQLite compartilhado por todas as sessões e processos
+SEARCH_CACHE_PATH = os.getenv("SEARCH_CACHE_PATH", os.path.join("cache", "search_cache.db"))
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL_DAYS", "30")) * 86400
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", "5000"))
+
+
+def _search_cache_connect():
+    """Abre o banco do cache de buscas (uma conexão por operação, segura entre threads)"""
+    pasta = os.path.dirname(SEARCH_CACHE_PATH)
+    if pasta:
+        os.makedirs(pasta, exist_ok=True)
+    
+    conn = sqlite3.connect(SEARCH_CACHE_PATH, timeout=10)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS buscas (
+            chave TEXT PRIMARY KEY,
+            resultados TEXT NOT NULL,
+            criado_em REAL NOT NULL,
+            acessado_em REAL NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS contadores (
+            nome TEXT PRIMARY KEY,
+            valor INTEGER NOT NULL
+        )
+    """)
+    return conn
+
+
+def normalize_search_key(query):
+    """Normaliza a query para uso como chave (maiúsculas/minúsculas e espaços)"""
+    return " ".join(str(query).lower().split())
+
+
+def _incrementar_contador(conn, nome):
+    conn.execute("""
+        INSERT INTO contadores (nome, valor) VALUES (?, 1)
+        ON CONFLICT(nome) DO UPDATE SET valor = valor + 1
+    """, (nome,))
+
+
+def search_cache_get(query):
+    """
+    Consulta o cache persistente.
+    
+    Returns:
+        Lista de resultados ou None (ausente ou expirado)
+    """
+    chave = normalize_search_key(query)
+    agora = time.time()
+    try:
+        with closing(_search_cache_connect()) as conn, conn:
+            linha = conn.execute(
+                "SELECT resultados, criado_em FROM buscas WHERE chave = ?", (chave,)
+            ).fetchone()
+            
+            if linha is None or agora - linha[1] > SEARCH_CACHE_TTL:
+                _incrementar_contador(conn, 'misses')
+                return None
+            
+            conn.execute("UPDATE buscas SET acessado_em = ? WHERE chave = ?", (agora, chave))
+            _incrementar_contador(conn, 'hits')
+            return json.loads(linha[0])
+    except Exception as e:
+        logger.warning(f"Cache de buscas indisponível: {e}")
+        return None
+
+
+def search_cache_put(query, resultados):
+    """Grava resultados no cache persistente, removendo expirados e os menos usados"""
+    chave = normalize_search_key(query)
+    agora = time.time()
+    try:
+        with closing(_search_cache_connect()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO buscas VALUES (?, ?, ?, ?)",
+                (chave, json.dumps(resultados), agora, agora)
+            )
+            conn.execute("DELETE FROM buscas WHERE criado_em < ?", (agora - SEARCH_CACHE_TTL,))
+            conn.execute("""
+                DELETE FROM buscas WHERE chave IN (
+                    SELECT chave FROM buscas
+                    ORDER BY acessado_em DESC
+                    LIMIT -1 OFFSET ?
+                )
+            """, (SEARCH_CACHE_MAX_ENTRIES,))
+    except Exception as e:
+        logger.warning(f"Falha ao gravar no cache de buscas: {e}")
+
+
+def search_cache_stats():
+    """Retorna entradas, acertos e falhas do cache persistente"""
+    try:
+        with closing(_search_cache_connect()) as conn:
+            entradas = conn.execute("SELECT COUNT(*) FROM buscas").fetchone()[0]
+            contadores = dict(conn.execute("SELECT nome, valor FROM contadores").fetchall())
+        return {
+            'entradas': entradas,
+            'hits': contadores.get('hits', 0),
+            'misses': contadores.get('misses', 0)
+        }
+    except Exception:
+        return {'entradas': 0, 'hits': 0, 'misses': 0}
+
+
+# ============================================
+# ATUALIZAÇÃO DA FUNÇÃO perform_search
+# ============================================
+
+def build_search_query(ean, description):
+    """Monta a query do Google priorizando o EAN"""
+    ean_clean = str(ean).replace('.0', '').strip() if pd.notna(ean) else ""
+    desc_clean = clean_text(description)
+    
+    # Prioriza EAN
+    if ean_clean and len(ean_clean) >= 8:
+        return f'"{ean_clean}" produto'
+    return f'{desc_clean} embalagem produto'
+
+
+def perform_search(ean, description, cache_key=None):
+    """
+    Gerencia busca com cache usando chave personalizada.
+    
+    Ordem de consulta: cache da sessão -> cache persistente (compartilhado
+    entre sessões) -> API do Google (consome quota).
+    
+    Args:
+        ean: EAN selecionado pelo usuário
+        description: Descrição do produto
+        cache_key: Chave única para cache (produto + EAN)
+    """
+    # Se não forneceu cache_key, usa lógica antiga
+    if not cache_key:
+        cache_key = str(ean) if pd.notna(ean) else description
+    
+    # Verifica cache
+    if cache_key in st.session_state.search_results:
+        logger.info(f"Usando cache para: {cache_key}")
+        return st.session_state.search_results[cache_key]
+
+    query = build_search_query(ean, description)
+    
+    # Verifica cache persistente
+    results = search_cache_get(query)
+    if results is not None:
+        logger.info(f"Usando cache persistente para: {query}")
+        st.session_state.search_results[cache_key] = results
+        return results
+
+    # Verifica quota
+    if not check_quota():
+        return []
+    
+    logger.info(f"Buscando com cache_key={cache_key}, query={query}")
+    
+    # Busca no Google
+    results = google_image_search_api(query, num_results=4)
+    
+    # Salva no cache com a chave correta (resultados vazios podem ser erro transitório)
+    st.session_state.search_results[cache_key] = results
+    if results:
+        search_cache_put(query, results)
+    st.session_state.api_quota['history'].append({
+        'timestamp': datetime.now(),
+        'query': query,
+        'results': len(results),
+        'cache_key': cache_key
+    })
+    
+    return results
+
+# --- 6. CONVERSÃO DE TIPOS NUMPY ---
+def convert_to_python_type(value):
+    """
+    Converte tipos numpy para tipos Python nativos.
+    Necessário para compatibilidade com Oracle/SQLAlchemy.
+    """
+    import numpy as np
+    
+    if isinstance(value, (np.integer, np.int64, np.int32)):
+        return int(value)
+    elif isinstance(value, (np.floating, np.float64, np.float32)):
+        return float(value)
+    elif isinstance(value, np.bool_):
+        return bool(value)
+    elif isinstance(value, np.ndarray):
+        return value.tolist()
+    elif pd.isna(value):
+        return None
+    else:
+        return value
+
+# --- 7. SALVAR IMAGEM NO SISTEMA ---
+# Relê DIRFOTOPROD após o UPDATE antes de atualizar o catálogo em memória
+PHOTO_SAVE_VERIFY = os.getenv("PHOTO_SAVE_VERIFY", "1") == "1"
+
+# Pipeline de gravação: download limitado, uma decodificação e saída otimizada
+IMAGE_MAX_BYTES = int(float(os.getenv("IMAGE_MAX_MB", "10")) * 1024 * 1024)
+IMAGE_MAX_PIXELS = 50_000_000
+PHOTO_MAX_DIM = int(os.getenv("PHOTO_MAX_DIM", "1200"))
+PHOTO_FORMAT = os.getenv("PHOTO_FORMAT", "JPEG").upper()
+PHOTO_QUALITY = int(os.getenv("PHOTO_QUALITY", "85"))
+PHOTO_WHITE_BACKGROUND = os.getenv("PHOTO_WHITE_BACKGROUND", "1") == "1"
+PHOTO_EXTENSIONS = {'JPEG': 'jpg', 'PNG': 'png', 'WEBP': 'webp'}
+
+
+def download_image(image_url, timeout=15):
+    """
+    Baixa a imagem em partes, abortando acima de IMAGE_MAX_BYTES, e valida
+    o cabeçalho (formato e dimensões) sem decodificar os pixels.
+    
+    Returns:
+        Bytes da imagem; levanta ValueError se não for uma imagem válida
+    """
+    with requests.get(image_url, timeout=timeout, stream=True) as response:
+        response.raise_for_status()
+        
+        tamanho = int(response.headers.get('Content-Length') or 0)
+        if tamanho > IMAGE_MAX_BYTES:
+            raise ValueError(f"Imagem muito grande ({tamanho / 1024**2:.1f} MB)")
+        
+        partes = []
+        recebido = 0
+        for parte in response.iter_content(chunk_size=64 * 1024):
+            recebido += len(parte)
+            if recebido > IMAGE_MAX_BYTES:
+                raise ValueError(f"Imagem excede {IMAGE_MAX_BYTES / 1024**2:.0f} MB")
+            partes.append(parte)
+    conteudo = b"".join(partes)
+    
+    try:
+        img = Image.open(BytesIO(conteudo))
+    except Exception as e:
+        raise ValueError(f"Arquivo baixado não é uma imagem válida: {e}")
+    if img.width * img.height > IMAGE_MAX_PIXELS:
+        raise ValueError(f"Dimensões excessivas: {img.size}")
+    
+    logger.info(f"Imagem validada: {img.format} {img.size}")
+    return conteudo
+
+
+def normalize_image(conteudo):
+    """
+    Decodifica uma única vez e normaliza para gravação: reduz para no máximo
+    PHOTO_MAX_DIM, aplica fundo branco em imagens transparentes e codifica
+    em PHOTO_FORMAT com PHOTO_QUALITY.
+    
+    Returns:
+        (bytes prontos para gravar, extensão do arquivo, hash perceptual)
+    """
+    formato = PHOTO_FORMAT if PHOTO_FORMAT in PHOTO_EXTENSIONS else "JPEG"
+    
+    try:
+        with Image.open(BytesIO(conteudo)) as img:
+            # JPEG: decodifica direto em escala reduzida (muito mais barato)
+            img.draft('RGB', (PHOTO_MAX_DIM, PHOTO_MAX_DIM))
+            img.load()
+            img.thumbnail((PHOTO_MAX_DIM, PHOTO_MAX_DIM), Image.LANCZOS)
+            
+            transparente = img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info)
+            if transparente and (PHOTO_WHITE_BACKGROUND or formato == "JPEG"):
+                rgba = img.convert('RGBA')
+                img = Image.new('RGB', rgba.size, (255, 255, 255))
+                img.paste(rgba, mask=rgba.getchannel('A'))
+            elif formato == "JPEG" or img.mode not in ('RGB', 'RGBA', 'L'):
+                img = img.convert('RGB')
+            
+            dhash = _dhash(img)
+            saida = BytesIO()
+            if formato == "PNG":
+                img.save(saida, format="PNG", optimize=True)
+            else:
+                img.save(saida, format=formato, quality=PHOTO_QUALITY, optimize=True)
+    except Exception as e:
+        raise ValueError(f"Falha ao processar imagem: {e}")
+    
+    return saida.getvalue(), PHOTO_EXTENSIONS[formato], dhash
+
+
+# Índice das fotos gravadas: hash do conteúdo (arquivos idênticos) e
+# hash perceptual (fotos parecidas entre produtos diferentes)
+PHOTO_INDEX_PATH = os.getenv("PHOTO_INDEX_PATH", os.path.join("cache", "photo_index.db"))
+# Distância de Hamming máxima (em 64 bits) para considerar duas fotos parecidas
+PHOTO_SIMILAR_DISTANCE = int(os.getenv("PHOTO_SIMILAR_DISTANCE", "6"))
+
+
+def _dhash(img):
+    """Hash perceptual (dHash de 64 bits) de uma imagem já decodificada"""
+    pequena = np.asarray(img.convert('L').resize((9, 8), Image.BILINEAR), dtype=np.int16)
+    bits = (pequena[:, 1:] > pequena[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big', signed=True)
+
+
+def _photo_index_connect():
+    pasta = os.path.dirname(PHOTO_INDEX_PATH)
+    if pasta:
+        os.makedirs(pasta, exist_ok=True)
+    
+    conn = sqlite3.connect(PHOTO_INDEX_PATH, timeout=30)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS fotos (
+            codprod INTEGER PRIMARY KEY,
+            caminho TEXT NOT NULL,
+            sha256 TEXT NOT NULL,
+            dhash INTEGER NOT NULL,
+            gravado_em REAL NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS fotos_sha256 ON fotos (sha256)")
+    conn.execute("CREATE INDEX IF NOT EXISTS fotos_caminho ON fotos (caminho)")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS semelhantes (
+            codprod INTEGER NOT NULL,
+            outro INTEGER NOT NULL,
+            distancia INTEGER NOT NULL,
+            PRIMARY KEY (codprod, outro)
+        )
+    """)
+    return conn
+
+
+def _register_photo(conn, codprod, caminho, sha256, dhash):
+    """
+    Registra a foto do produto e recalcula as fotos parecidas de outros
+    produtos (distância 0 com o mesmo conteúdo = foto idêntica).
+    """
+    conn.execute(
+        "INSERT OR REPLACE INTO fotos VALUES (?, ?, ?, ?, ?)",
+        (codprod, caminho, sha256, dhash, time.time())
+    )
+    conn.execute("DELETE FROM semelhantes WHERE codprod = ? OR outro = ?", (codprod, codprod))
+    
+    outros = conn.execute("SELECT codprod, dhash FROM fotos WHERE codprod <> ?", (codprod,)).fetchall()
+    if not outros:
+        return []
+    
+    codigos = np.array([c for c, _ in outros], dtype=np.int64)
+    hashes = np.array([h for _, h in outros], dtype=np.int64)
+    diferencas = np.bitwise_xor(hashes, np.int64(dhash)).view(np.uint8).reshape(-1, 8)
+    distancias = np.unpackbits(diferencas, axis=1).sum(axis=1)
+    
+    parecidos = [
+        (codprod, int(outro), int(d))
+        for outro, d in zip(codigos, distancias) if d <= PHOTO_SIMILAR_DISTANCE
+    ]
+    conn.executemany(
+        "INSERT OR REPLACE INTO semelhantes VALUES (?, ?, ?)",
+        parecidos + [(outro, cod, d) for cod, outro, d in parecidos]
+    )
+    if parecidos:
+        logger.warning(f"Foto do produto {codprod} parecida com a de {len(parecidos)} outros produtos")
+    return parecidos
+
+
+def similar_photos(codprod):
+    """
+    Produtos com foto igual ou parecida com a do produto informado.
+    
+    Returns:
+        Lista de (codprod, distância) ordenada pela distância
+    """
+    try:
+        with closing(_photo_index_connect()) as conn:
+            return conn.execute(
+                "SELECT outro, distancia FROM semelhantes WHERE codprod = ? ORDER BY distancia, outro",
+                (int(codprod),)
+            ).fetchall()
+    except Exception as e:
+        logger.warning(f"Índice de fotos indisponível: {e}")
+        return []
+
+
+def write_product_photo(codprod, conteudo):
+    """
+    Normaliza e grava a foto no diretório do WinThor (sem tocar no banco).
+    
+    Se um arquivo com o mesmo conteúdo já existe (de outro produto), ele é
+    reutilizado em vez de gravar uma cópia. Fotos parecidas com as de outros
+    produtos ficam registradas no índice (ver similar_photos).
+    
+    Returns:
+        Caminho gravado; levanta ValueError se não for uma imagem válida
+    """
+    codprod = int(codprod)
+    foto, extensao, dhash = normalize_image(conteudo)
+    sha256 = hashlib.sha256(foto).hexdigest()
+    
+    # Definir caminho (AJUSTAR CONFORME SEU AMBIENTE)
+    img_dir = os.getenv("WINTHOR_IMAGE_DIR", "fotos_produtos")
+    
+    with closing(_photo_index_connect()) as conn, conn:
+        # Conteúdo idêntico já gravado: aponta para o mesmo arquivo
+        filepath = None
+        for caminho, in conn.execute("SELECT caminho FROM fotos WHERE sha256 = ?", (sha256,)):
+            if os.path.exists(caminho):
+                filepath = caminho
+                logger.info(f"Imagem idêntica reutilizada: {filepath}")
+                break
+        
+        if filepath is None:
+            # Criar diretório se não existir
+            os.makedirs(img_dir, exist_ok=True)
+            
+            filepath = os.path.join(img_dir, f"{codprod}.{extensao}")
+            
+            # Não sobrescreve um arquivo que outro produto reutiliza
+            compartilhado = conn.execute(
+                "SELECT 1 FROM fotos WHERE caminho = ? AND codprod <> ?", (filepath, codprod)
+            ).fetchone()
+            if compartilhado:
+                filepath = os.path.join(img_dir, f"{codprod}_{sha256[:8]}.{extensao}")
+            
+            # Salvar arquivo já normalizado
+            with open(filepath, 'wb') as f:
+                f.write(foto)
+            
+            logger.info(f"Imagem salva em: {filepath} ({len(conteudo) / 1024:.0f} KB -> {len(foto) / 1024:.0f} KB)")
+        
+        _register_photo(conn, codprod, filepath, sha256, dhash)
+    
+    return filepath
+
+
+# Atualizações de DIRFOTOPROD: array binding, uma transação por lote
+PHOTO_UPDATE_BATCH = int(os.getenv("PHOTO_UPDATE_BATCH", "500"))
+PHOTO_UPDATE_RETRIES = int(os.getenv("PHOTO_UPDATE_RETRIES", "2"))
+PHOTO_UPDATE_SQL = "UPDATE PCPRODUT SET DIRFOTOPROD = :filepath WHERE CODPROD = :codprod"
+
+
+def _execute_photo_batch(conn, lote):
+    """
+    Executa um lote com executemany e batcherrors.
+    
+    Returns:
+        Tupla (lista com None (gravado) ou a mensagem de erro de cada linha,
+        True se o lote inteiro falhou, ex.: conexão perdida)
+    """
+    cursor = conn.cursor()
+    try:
+        cursor.executemany(
+            PHOTO_UPDATE_SQL,
+            [{'filepath': caminho, 'codprod': codprod} for codprod, caminho in lote],
+            batcherrors=True,
+            arraydmlrowcounts=True
+        )
+        erros = {erro.offset: erro.message for erro in cursor.getbatcherrors()}
+        contagens = cursor.getarraydmlrowcounts()
+        conn.commit()
+    except Exception as e:
+        # O lote inteiro falhou (ex.: conexão): todas as linhas voltam para nova tentativa
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+        return [str(e)] * len(lote), True
+    finally:
+        cursor.close()
+    
+    return [
+        erros[i] if i in erros else (None if contagens[i] else "Produto não encontrado")
+        for i in range(len(lote))
+    ], False
+
+
+def _read_photo_paths(conn, codprods):
+    """Relê DIRFOTOPROD dos produtos (em lotes de 1000 binds)"""
+    gravados = {}
+    cursor = conn.cursor()
+    try:
+        for inicio in range(0, len(codprods), ORACLE_IN_LIMIT):
+            lote = codprods[inicio:inicio + ORACLE_IN_LIMIT]
+            params = {f"c{i}": cod for i, cod in enumerate(lote)}
+            binds = ", ".join(f":{nome}" for nome in params)
+            cursor.execute(f"SELECT CODPROD, DIRFOTOPROD FROM PCPRODUT WHERE CODPROD IN ({binds})", params)
+            gravados.update(cursor.fetchall())
+    finally:
+        cursor.close()
+    return gravados
+
+
+def update_photo_paths(atualizacoes):
+    """
+    Grava DIRFOTOPROD de vários produtos com poucas idas ao Oracle: um
+    executemany + commit por lote de PHOTO_UPDATE_BATCH linhas. Linhas que
+    falharem são reenviadas em novo lote até PHOTO_UPDATE_RETRIES vezes.
+    Os produtos gravados são atualizados no catálogo em memória.
+    
+    Args:
+        atualizacoes: lista de (codprod, caminho)
+    
+    Returns:
+        {codprod: (True, caminho gravado) ou (False, mensagem de erro)};
+        sem conexão com o Oracle, todas as linhas voltam com o erro
+    """
+    resultado = {}
+    pendentes = [(int(codprod), str(caminho)) for codprod, caminho in atualizacoes]
+    
+    conn = None
+    try:
+        for tentativa in range(PHOTO_UPDATE_RETRIES + 1):
+            if tentativa:
+                logger.warning(f"Repetindo {len(pendentes)} atualizações de DIRFOTOPROD (tentativa {tentativa + 1})")
+            
+            if conn is None:
+                # Primeira tentativa ou conexão anterior descartada: pega outra do pool
+                try:
+                    conn = get_db_engine().raw_connection()
+                except Exception as e:
+                    logger.error(f"Sem conexão para gravar DIRFOTOPROD: {e}")
+                    for codprod, caminho in pendentes:
+                        resultado[codprod] = (False, f"Sem conexão com o Oracle: {e}")
+                    break
+            
+            falhas = []
+            for inicio in range(0, len(pendentes), PHOTO_UPDATE_BATCH):
+                lote = pendentes[inicio:inicio + PHOTO_UPDATE_BATCH]
+                if conn is None:
+                    # Conexão perdida nesta tentativa: o restante fica para a próxima
+                    for codprod, caminho in lote:
+                        resultado[codprod] = (False, "Conexão com o Oracle perdida")
+                    falhas.extend(lote)
+                    continue
+                
+                erros, lote_falhou = _execute_photo_batch(conn, lote)
+                if lote_falhou:
+                    # Possível conexão morta: descarta do pool em vez de devolver
+                    conn.invalidate()
+                    conn.close()
+                    conn = None
+                
+                for (codprod, caminho), erro in zip(lote, erros):
+                    if erro is None:
+                        resultado[codprod] = (True, caminho)
+                    else:
+                        resultado[codprod] = (False, erro)
+                        if erro != "Produto não encontrado":
+                            falhas.append((codprod, caminho))
+            
+            pendentes = falhas
+            if not pendentes:
+                break
+        
+        gravados = [codprod for codprod, (ok, _) in resultado.items() if ok]
+        logger.info(f"DIRFOTOPROD atualizado: {len(gravados)} de {len(resultado)} produtos")
+        
+        # Releitura em lote para confirmar os valores gravados
+        if PHOTO_SAVE_VERIFY and gravados and conn is not None:
+            for codprod, gravado in _read_photo_paths(conn, gravados).items():
+                if gravado != resultado[codprod][1]:
+                    logger.warning(f"DIRFOTOPROD divergente após UPDATE ({codprod}): {gravado}")
+                resultado[codprod] = (True, gravado)
+    finally:
+        if conn is not None:
+            conn.close()
+    
+    fotos = {codprod: caminho for codprod, (ok, caminho) in resultado.items() if ok}
+    for caminho in fotos.values():
+        forget_photo_stat(caminho)
+    patch_catalog_photos(fotos)
+    if fotos:
+        # Consulta direta: os resultados em cache trazem o DIRFOTOPROD antigo
+        query_catalog.clear()
+    
+    return resultado
+
+
+def save_image_to_winthor(codprod, image_url, conteudo=None):
+    """
+    Baixa imagem da URL e salva no diretório do WinThor.
+    Atualiza o campo DIRFOTOPROD no Oracle.
+    
+    Args:
+        conteudo: Bytes já baixados e validados (evita novo download)
+    """
+    try:
+        # Converter para tipo Python nativo (resolve problema com numpy.int64)
+        codprod = convert_to_python_type(codprod)
+        
+        logger.info(f"Iniciando salvamento de imagem para produto {codprod}")
+        
+        # Baixar imagem e gravar o arquivo
+        try:
+            if conteudo is None:
+                conteudo = download_image(image_url)
+            filepath = write_product_photo(codprod, conteudo)
+        except ValueError as e:
+            # Motivo da recusa: formato inválido, tamanho ou dimensões acima do limite
+            st.error(f"❌ {e}")
+            logger.error(f"Validação de imagem falhou: {e}")
+            return False
+        
+        # Atualizar banco Oracle (mesmo caminho do salvamento em lote)
+        ok, detalhe = update_photo_paths([(codprod, filepath)])[int(codprod)]
+        if not ok:
+            st.error(f"❌ Erro ao salvar: {detalhe}")
+            logger.error(f"UPDATE DIRFOTOPROD falhou para {codprod}: {detalhe}")
+            return False
+        
+        logger.info(f"Banco atualizado para produto {codprod}")
+        return True
+        
+    except requests.exceptions.RequestException as e:
+        st.error(f"❌ Erro ao baixar imagem: {e}")
+        logger.error(f"Download error: {e}")
+        return False
+    except Exception as e:
+        st.error(f"❌ Erro ao salvar: {e}")
+        logger.error(f"Save error: {e}", exc_info=True)
+        return False
+
+# ============================================
+# CACHE LOCAL DE IMAGENS CANDIDATAS
+# ============================================
+
+# Original (para salvar sem novo download) e miniatura (para exibir) por URL
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", os.path.join("cache", "imagens"))
+IMAGE_CACHE_TTL = int(os.getenv("IMAGE_CACHE_TTL_DAYS", "7")) * 86400
+IMAGE_PREFETCH_WORKERS = int(os.getenv("IMAGE_PREFETCH_WORKERS", "4"))
+THUMBNAIL_SIZE = (256, 256)
+
+
+def _image_cache_paths(url):
+    """Caminhos do original e da miniatura no cache (chave = hash da URL)"""
+    chave = hashlib.sha1(url.encode('utf-8')).hexdigest()
+    return (
+        os.path.join(IMAGE_CACHE_DIR, f"{chave}.img"),
+        os.path.join(IMAGE_CACHE_DIR, f"{chave}_thumb.jpg")
+    )
+
+
+def fetch_candidate(url):
+    """
+    Baixa, valida e gera a miniatura de uma imagem candidata (ou usa o cache).
+    Sem st.* para poder rodar em threads.
+    
+    Returns:
+        {'link', 'arquivo', 'thumbnail'} ou None se a imagem for inválida/inacessível
+    """
+    original, miniatura = _image_cache_paths(url)
+    if os.path.exists(original) and os.path.exists(miniatura):
+        return {'link': url, 'arquivo': original, 'thumbnail': miniatura}
+    
+    try:
+        conteudo = download_image(url)
+        os.makedirs(IMAGE_CACHE_DIR, exist_ok=True)
+        with Image.open(BytesIO(conteudo)) as img:
+            img.draft('RGB', THUMBNAIL_SIZE)
+            img.thumbnail(THUMBNAIL_SIZE)
+            img.convert('RGB').save(miniatura, format="JPEG", quality=85)
+        with open(original, 'wb') as f:
+            f.write(conteudo)
+    except Exception as e:
+        logger.info(f"Candidato descartado ({url}): {e}")
+        return None
+    
+    return {'link': url, 'arquivo': original, 'thumbnail': miniatura}
+
+
+def prefetch_candidates(resultados):
+    """
+    Baixa os candidatos de uma busca em paralelo.
+    
+    Returns:
+        Lista na ordem original, só com as imagens válidas
+    """
+    links = [item['link'] for item in resultados if item.get('link')]
+    if not links:
+        return []
+    with ThreadPoolExecutor(max_workers=min(IMAGE_PREFETCH_WORKERS, len(links))) as pool:
+        candidatos = list(pool.map(fetch_candidate, links))
+    return [c for c in candidatos if c is not None]
+
+
+def refetch_missing_candidates(candidatos):
+    """
+    Baixa de novo os candidatos cujos arquivos saíram do cache de imagens
+    (os caminhos dependem só da URL, então os dicionários continuam valendo).
+    
+    Returns:
+        Lista na mesma ordem, sem os candidatos que não puderam ser baixados
+    """
+    faltando = [
+        c for c in candidatos
+        if not (os.path.exists(c['arquivo']) and os.path.exists(c['thumbnail']))
+    ]
+    if not faltando:
+        return candidatos
+    recuperados = {c['link'] for c in prefetch_candidates(faltando)}
+    return [c for c in candidatos if c not in faltando or c['link'] in recuperados]
+
+
+def read_cached_image(url):
+    """Bytes do original já baixado (ou None se não estiver no cache)"""
+    original, _ = _image_cache_paths(url)
+    try:
+        with open(original, 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def purge_image_cache():
     """
-    Consulta a API Custom Search do Google com tratamento completo de erros.
-    Retorna uma lista de dicionários com 'link' e 'thumbnail'.
+    Remove do cache as imagens mais antigas que IMAGE_CACHE_TTL, menos as dos
+    candidatos que ainda aguardam revisão na fila de lotes.
     """
-    api_key = os.getenv("GOOGLE_API_KEY")
-    cse_id = os.getenv("GOOGLE_CSE_ID")
+    try:
+        em_revisao = review_candidate_files()
+    except Exception as e:
+        logger.warning(f"Limpeza do cache de imagens adiada (fila de revisão indisponível): {e}")
+        return 0
     
-    if not api_key or not cse_id:
-        st.error("⚠️ Configuração da API do Google ausente no .env")
-        logger.error("API Key ou CSE ID não encontrados")
-        return []
+    limite = time.time() - IMAGE_CACHE_TTL
+    removidos = 0
+    if os.path.isdir(IMAGE_CACHE_DIR):
+        for arquivo in os.listdir(IMAGE_CACHE_DIR):
+            caminho = os.path.join(IMAGE_CACHE_DIR, arquivo)
+            if os.path.abspath(caminho) in em_revisao:
+                continue
+            if os.path.getmtime(caminho) < limite:
+                os.remove(caminho)
+                removidos += 1
+    return removidos
 
-    url = "https://www.googleapis.com/customsearch/v1"
-    params = {
-        'q': query,
-        'cx': cse_id,
-        'key': api_key,
-        'searchType': 'image',
-        'num': num_results,
-        'fileType': 'jpg,png,jpeg',
-        'gl': 'br',
-        'hl': 'pt',
-        'safe': 'active'
+# ============================================
+# MINIATURAS DAS FOTOS DO WINTHOR
+# ============================================
+
+# Prévia local das fotos cadastradas (DIRFOTOPROD costuma ser um drive de rede)
+PHOTO_THUMB_DIR = os.getenv("PHOTO_THUMB_DIR", os.path.join("cache", "fotos"))
+# Por quanto tempo (s) o mtime/tamanho lido do compartilhamento é considerado atual
+PHOTO_STAT_TTL = int(os.getenv("PHOTO_STAT_TTL", "300"))
+PHOTO_PREVIEW_SIZE = (512, 512)
+
+
+@st.cache_resource
+def get_photo_thumb_store():
+    """Estado do processo: stat das fotos, pool do pré-aquecimento e itens em andamento"""
+    return {
+        'stat': {},
+        'pool': ThreadPoolExecutor(max_workers=2, thread_name_prefix="photo-thumb"),
+        'em_andamento': set(),
+        'lock': threading.Lock()
     }
+
+
+def _stat_photo(store, caminho):
+    """(mtime, tamanho) da foto, consultando o compartilhamento no máximo a cada PHOTO_STAT_TTL"""
+    agora = time.time()
+    cache = store['stat'].get(caminho)
+    if cache is not None and agora - cache[0] < PHOTO_STAT_TTL:
+        return cache[1]
     
     try:
-        response = requests.get(url, params=params, timeout=10)
-        response.raise_for_status()  # ✅ Verifica status HTTP
-        
-        data = response.json()
-        
-        if 'items' in data:
-            logger.info(f"Busca bem-sucedida: {len(data['items'])} imagens para '{query}'")
-            return data['items']
-        elif 'error' in data:
-            error_msg = data['error'].get('message', 'Erro desconhecido')
-            st.error(f"❌ Erro da API: {error_msg}")
-            logger.error(f"Erro API Google: {error_msg}")
-            return []
-        else:
-            logger.warning(f"Nenhuma imagem encontrada para: {query}")
-            return []
-            
-    except requests.exceptions.Timeout:
-        st.warning("⏱️ Tempo limite esgotado. Tente novamente.")
-        logger.warning(f"Timeout na busca: {query}")
-        return []
-    except requests.exceptions.HTTPError as e:
-        st.error(f"❌ Erro HTTP {e.response.status_code}: {e.response.text}")
-        logger.error(f"HTTP Error: {e}")
-        return []
-    except requests.exceptions.RequestException as e:
-        st.error(f"❌ Erro de conexão: {str(e)}")
-        logger.error(f"Request Error: {e}")
-        return []
-    except Exception as e:
-        st.error(f"❌ Erro inesperado: {e}")
-        logger.error(f"Unexpected error: {e}")
-        return []
+        info = os.stat(caminho)
+        stat = (info.st_mtime_ns, info.st_size)
+    except OSError:
+        stat = None
+    store['stat'][caminho] = (agora, stat)
+    return stat
 
-# ============================================
-# ATUALIZAÇÃO DA FUNÇÃO perform_search
-# ============================================
 
-def perform_search(ean, description, cache_key=None):
+def get_photo_thumbnail(caminho, store=None):
     """
-    Gerencia busca com cache usando chave personalizada.
+    Miniatura local da foto cadastrada, gerada na primeira vez que é pedida.
+    A chave inclui mtime e tamanho, então uma foto substituída gera outra miniatura.
     
-    Args:
-        ean: EAN selecionado pelo usuário
-        description: Descrição do produto
-        cache_key: Chave única para cache (produto + EAN)
+    Returns:
+        Caminho da miniatura ou None se a foto não existir; levanta exceção
+        se o arquivo não for uma imagem válida
     """
-    # Se não forneceu cache_key, usa lógica antiga
-    if not cache_key:
-        cache_key = str(ean) if pd.notna(ean) else description
+    store = store or get_photo_thumb_store()
+    stat = _stat_photo(store, caminho)
+    if stat is None:
+        return None
     
-    # Verifica cache
-    if cache_key in st.session_state.search_results:
-        logger.info(f"Usando cache para: {cache_key}")
-        return st.session_state.search_results[cache_key]
+    chave = hashlib.sha1(f"{caminho}|{stat[0]}|{stat[1]}".encode('utf-8')).hexdigest()
+    miniatura = os.path.join(PHOTO_THUMB_DIR, f"{chave}.jpg")
+    if os.path.exists(miniatura):
+        return miniatura
+    
+    os.makedirs(PHOTO_THUMB_DIR, exist_ok=True)
+    temporario = f"{miniatura}.{threading.get_ident()}.tmp"
+    with Image.open(caminho) as img:
+        img.draft('RGB', PHOTO_PREVIEW_SIZE)
+        img.thumbnail(PHOTO_PREVIEW_SIZE)
+        img.convert('RGB').save(temporario, format="JPEG", quality=85)
+    os.replace(temporario, miniatura)
+    return miniatura
 
-    # Verifica quota
-    if not check_quota():
-        return []
 
-    ean_clean = str(ean).replace('.0', '').strip() if pd.notna(ean) else ""
-    desc_clean = clean_text(description)
-    
-    # Prioriza EAN
-    if ean_clean and len(ean_clean) >= 8:
-        query = f'"{ean_clean}" produto'
-    else:
-        query = f'{desc_clean} embalagem produto'
-    
-    logger.info(f"Buscando com cache_key={cache_key}, query={query}")
+def forget_photo_stat(caminho):
+    """Descarta o stat em cache de uma foto recém-gravada"""
+    get_photo_thumb_store()['stat'].pop(caminho, None)
+
+
+def prewarm_photo_thumbnails(caminhos):
+    """Gera em segundo plano as miniaturas das fotos (ex.: página atual da tabela)"""
+    store = get_photo_thumb_store()
     
-    # Busca no Google
-    results = google_image_search_api(query, num_results=4)
+    def gerar(caminho):
+        try:
+            get_photo_thumbnail(caminho, store)
+        except Exception as e:
+            logger.info(f"Miniatura não gerada ({caminho}): {e}")
+        finally:
+            with store['lock']:
+                store['em_andamento'].discard(caminho)
     
-    # Salva no cache com a chave correta
-    st.session_state.search_results[cache_key] = results
-    st.session_state.api_quota['history'].append({
-        'timestamp': datetime.now(),
-        'query': query,
-        'results': len(results),
-        'cache_key': cache_key
-    })
+    for caminho in set(caminhos):
+        if not caminho:
+            continue
+        with store['lock']:
+            if caminho in store['em_andamento']:
+                continue
+            store['em_andamento'].add(caminho)
+        store['pool'].submit(gerar, caminho)
+
+# ============================================
+# BUSCA DE FOTOS EM LOTE (FILA DE REVISÃO)
+# ============================================
+
+# Estado dos lotes em SQLite: sobrevive a reinícios e é compartilhado entre processos
+ENRICH_DB_PATH = os.getenv("ENRICH_DB_PATH", os.path.join("cache", "enrichment.db"))
+ENRICH_WORKERS = int(os.getenv("ENRICH_WORKERS", "4"))
+ENRICH_MAX_ITEMS = int(os.getenv("ENRICH_MAX_ITEMS", "5000"))
+ENRICH_CANDIDATES = int(os.getenv("ENRICH_CANDIDATES", "4"))
+# Buscas por hora reservadas para o uso interativo (o lote para antes disso)
+ENRICH_QUOTA_RESERVE = int(os.getenv("ENRICH_QUOTA_RESERVE", "20"))
+ENRICH_REVIEW_PAGE = int(os.getenv("ENRICH_REVIEW_PAGE", "10"))
+# Itens 'buscando' há mais tempo que isso foram abandonados (processo reiniciado)
+ENRICH_STALE_AFTER = 600
+
+
+def _enrich_connect():
+    """Abre o banco dos lotes em modo autocommit (as transações são explícitas)"""
+    pasta = os.path.dirname(ENRICH_DB_PATH)
+    if pasta:
+        os.makedirs(pasta, exist_ok=True)
     
-    return results
+    conn = sqlite3.connect(ENRICH_DB_PATH, timeout=30, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS lotes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            descricao TEXT,
+            criado_em REAL NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS itens (
+            lote_id INTEGER NOT NULL,
+            codprod INTEGER NOT NULL,
+            ean TEXT,
+            descricao TEXT,
+            status TEXT NOT NULL,
+            candidatos TEXT,
+            erro TEXT,
+            atualizado_em REAL NOT NULL,
+            PRIMARY KEY (lote_id, codprod)
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS itens_status ON itens (status, lote_id, codprod)")
+    return conn
 
-# --- 6. CONVERSÃO DE TIPOS NUMPY ---
-def convert_to_python_type(value):
+
+def create_enrichment_job(df, descricao):
     """
-    Converte tipos numpy para tipos Python nativos.
-    Necessário para compatibilidade com Oracle/SQLAlchemy.
+    Cria um lote com os produtos do DataFrame (uma linha por CODPROD).
+    Produtos que já estão na fila ou em revisão em outro lote são ignorados.
+    
+    Returns:
+        (id do lote, quantidade de itens enfileirados)
     """
-    import numpy as np
+    produtos = df.drop_duplicates('CODPROD').head(ENRICH_MAX_ITEMS)
+    agora = time.time()
+    itens = [
+        (int(linha['CODPROD']), get_primary_ean(linha), str(linha['DESCRICAO']))
+        for _, linha in produtos.iterrows()
+    ]
     
-    if isinstance(value, (np.integer, np.int64, np.int32)):
-        return int(value)
-    elif isinstance(value, (np.floating, np.float64, np.float32)):
-        return float(value)
-    elif isinstance(value, np.bool_):
-        return bool(value)
-    elif isinstance(value, np.ndarray):
-        return value.tolist()
-    elif pd.isna(value):
-        return None
-    else:
-        return value
+    with closing(_enrich_connect()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        lote_id = conn.execute(
+            "INSERT INTO lotes (descricao, criado_em) VALUES (?, ?)", (descricao, agora)
+        ).lastrowid
+        antes = conn.total_changes
+        conn.executemany("""
+            INSERT INTO itens (lote_id, codprod, ean, descricao, status, atualizado_em)
+            SELECT ?, ?, ?, ?, 'pendente', ?
+            WHERE NOT EXISTS (
+                SELECT 1 FROM itens
+                WHERE codprod = ? AND status IN ('pendente', 'buscando', 'revisao')
+            )
+        """, [(lote_id, cod, ean, desc, agora, cod) for cod, ean, desc in itens])
+        inseridos = conn.total_changes - antes
+        conn.execute("COMMIT")
+    
+    logger.info(f"Lote {lote_id} criado com {inseridos} produtos")
+    return lote_id, inseridos
 
-# --- 7. SALVAR IMAGEM NO SISTEMA ---
-def save_image_to_winthor(codprod, image_url):
+
+def _claim_enrichment_items(limite):
+    """Reserva itens pendentes (ou abandonados) para processamento"""
+    agora = time.time()
+    with closing(_enrich_connect()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        itens = conn.execute("""
+            SELECT lote_id, codprod, ean, descricao FROM itens
+            WHERE status = 'pendente' OR (status = 'buscando' AND atualizado_em < ?)
+            ORDER BY lote_id, codprod
+            LIMIT ?
+        """, (agora - ENRICH_STALE_AFTER, limite)).fetchall()
+        conn.executemany(
+            "UPDATE itens SET status = 'buscando', atualizado_em = ? WHERE lote_id = ? AND codprod = ?",
+            [(agora, lote_id, codprod) for lote_id, codprod, _, _ in itens]
+        )
+        conn.execute("COMMIT")
+    return itens
+
+
+def _set_enrichment_status(lote_id, codprod, status, candidatos=None, erro=None):
+    with closing(_enrich_connect()) as conn:
+        conn.execute("""
+            UPDATE itens SET status = ?, candidatos = ?, erro = ?, atualizado_em = ?
+            WHERE lote_id = ? AND codprod = ?
+        """, (
+            status, json.dumps(candidatos) if candidatos is not None else None,
+            erro, time.time(), lote_id, codprod
+        ))
+
+
+def _process_enrichment_item(lote_id, codprod, ean, descricao):
     """
-    Baixa imagem da URL e salva no diretório do WinThor.
-    Atualiza o campo DIRFOTOPROD no Oracle.
+    Busca (cache persistente -> Google) e baixa os candidatos de um produto.
+    Roda nas threads do lote: nada de st.* aqui.
+    
+    Returns:
+        False se a quota acabou (o item volta para a fila), True caso contrário
     """
+    query = build_search_query(ean, descricao)
     try:
-        # Converter para tipo Python nativo (resolve problema com numpy.int64)
-        codprod = convert_to_python_type(codprod)
+        resultados = search_cache_get(query)
+        if resultados is None:
+            if quota_status()['hora']['restante'] <= ENRICH_QUOTA_RESERVE or not acquire_quota():
+                _set_enrichment_status(lote_id, codprod, 'pendente')
+                return False
+            resultados = _google_image_request(query, num_results=ENRICH_CANDIDATES)
+            if resultados:
+                search_cache_put(query, resultados)
         
-        logger.info(f"Iniciando salvamento de imagem para produto {codprod}")
+        candidatos = prefetch_candidates(resultados[:ENRICH_CANDIDATES])
         
-        # Baixar imagem
-        response = requests.get(image_url, timeout=15, stream=True)
-        response.raise_for_status()
+        _set_enrichment_status(
+            lote_id, codprod, 'revisao' if candidatos else 'sem_resultado', candidatos
+        )
+    except Exception as e:
+        logger.error(f"Lote {lote_id}, produto {codprod}: {e}")
+        _set_enrichment_status(lote_id, codprod, 'erro', erro=str(e))
+    return True
+
+
+@st.cache_resource
+def start_enrichment_worker():
+    """
+    Inicia (uma vez por processo) a thread que consome a fila dos lotes com
+    um pool de ENRICH_WORKERS threads. Como o estado está no SQLite, um lote
+    interrompido continua de onde parou quando o app volta.
+    """
+    pool = ThreadPoolExecutor(max_workers=ENRICH_WORKERS, thread_name_prefix="enrichment")
+    
+    def consumidor():
+        while True:
+            try:
+                itens = _claim_enrichment_items(ENRICH_WORKERS)
+                if not itens:
+                    time.sleep(5)
+                    continue
+                
+                resultados = list(pool.map(lambda item: _process_enrichment_item(*item), itens))
+                if not all(resultados):
+                    # Quota esgotada: espera o próximo token antes de tentar de novo
+                    espera = quota_status()['hora']['proximo_em']
+                    logger.info(f"Lote pausado por quota ({espera:.0f}s)")
+                    time.sleep(min(max(espera, 5), 300))
+            except Exception as e:
+                logger.error(f"Erro no processamento em lote: {e}")
+                time.sleep(30)
+    
+    thread = threading.Thread(target=consumidor, name="enrichment-worker", daemon=True)
+    thread.start()
+    return thread
+
+
+def enrichment_progress():
+    """Contagem de itens por status (todos os lotes)"""
+    try:
+        with closing(_enrich_connect()) as conn:
+            return dict(conn.execute("SELECT status, COUNT(*) FROM itens GROUP BY status").fetchall())
+    except Exception as e:
+        logger.warning(f"Fila de lotes indisponível: {e}")
+        return {}
+
+
+def list_review_items(limite=ENRICH_REVIEW_PAGE):
+    """Itens com candidatos aguardando aprovação"""
+    with closing(_enrich_connect()) as conn:
+        itens = conn.execute("""
+            SELECT lote_id, codprod, ean, descricao, candidatos FROM itens
+            WHERE status = 'revisao'
+            ORDER BY lote_id, codprod
+            LIMIT ?
+        """, (limite,)).fetchall()
+    return [
+        {'lote_id': lote_id, 'codprod': codprod, 'ean': ean,
+         'descricao': descricao, 'candidatos': json.loads(candidatos)}
+        for lote_id, codprod, ean, descricao, candidatos in itens
+    ]
+
+
+def review_candidate_files():
+    """Caminhos absolutos dos arquivos de cache usados pelos itens em revisão"""
+    with closing(_enrich_connect()) as conn:
+        linhas = conn.execute("SELECT candidatos FROM itens WHERE status = 'revisao'").fetchall()
+    return {
+        os.path.abspath(candidato[chave])
+        for (candidatos,) in linhas
+        for candidato in json.loads(candidatos)
+        for chave in ('arquivo', 'thumbnail')
+    }
+
+
+def refresh_review_candidates(itens):
+    """
+    Garante os arquivos locais dos candidatos da revisão. Os que não puderem
+    ser baixados de novo saem do item (sem candidatos, o item vai para
+    'sem_resultado'), para não repetir o download a cada rerun.
+    """
+    validos = []
+    for item in itens:
+        candidatos = refetch_missing_candidates(item['candidatos'])
+        if len(candidatos) < len(item['candidatos']):
+            _set_enrichment_status(
+                item['lote_id'], item['codprod'],
+                'revisao' if candidatos else 'sem_resultado', candidatos
+            )
+        if candidatos:
+            validos.append({**item, 'candidatos': candidatos})
+    return validos
+
+
+def review_enrichment_items(decisoes):
+    """
+    Aplica as decisões da revisão.
+    
+    Args:
+        decisoes: lista de (item, índice do candidato escolhido ou None para rejeitar)
+    
+    Returns:
+        (aprovados, rejeitados, falhas)
+    """
+    rejeitados = falhas = 0
+    arquivos = []
+    for item, escolha in decisoes:
+        if escolha is None:
+            _set_enrichment_status(item['lote_id'], item['codprod'], 'rejeitado')
+            rejeitados += 1
+            continue
         
-        # Validar se é uma imagem válida
+        candidato = item['candidatos'][escolha]
         try:
-            img = Image.open(BytesIO(response.content))
-            img.verify()
-            logger.info(f"Imagem validada: {img.format} {img.size}")
+            conteudo = read_cached_image(candidato['link']) or download_image(candidato['link'])
+            arquivos.append((item, write_product_photo(item['codprod'], conteudo)))
         except Exception as e:
-            st.error("❌ Arquivo baixado não é uma imagem válida")
-            logger.error(f"Validação de imagem falhou: {e}")
-            return False
-        
-        # Definir caminho (AJUSTAR CONFORME SEU AMBIENTE)
-        img_dir = os.getenv("WINTHOR_IMAGE_DIR", "fotos_produtos")
-        
-        # Criar diretório se não existir
-        os.makedirs(img_dir, exist_ok=True)
-        
-        filename = f"{codprod}.png"
-        filepath = os.path.join(img_dir, filename)
-        
-        # Salvar arquivo localmente convertendo para PNG
-        image_data = BytesIO(response.content)
-        with Image.open(image_data) as img_save:
-            img_save.save(filepath, format="PNG")
-        
-        logger.info(f"Imagem salva em: {filepath}")
-        
-        # Atualizar banco Oracle
-        engine = get_db_engine()
-        with engine.connect() as conn:
-            query = text("""
-                UPDATE PCPRODUT 
-                SET DIRFOTOPROD = :filepath 
-                WHERE CODPROD = :codprod
-            """)
-            # Garante tipos Python nativos
-            params = {
-                'filepath': str(filepath), 
-                'codprod': int(codprod)
-            }
-            logger.info(f"Executando UPDATE com params: {params}")
-            
-            result = conn.execute(query, params)
-            conn.commit()
-            
-            logger.info(f"Linhas afetadas: {result.rowcount}")
-        
-        logger.info(f"Banco atualizado para produto {codprod}")
-        
-        # Limpar cache para forçar reload
-        fetch_product_data.clear()
-        
-        return True
-        
-    except requests.exceptions.RequestException as e:
-        st.error(f"❌ Erro ao baixar imagem: {e}")
-        logger.error(f"Download error: {e}")
-        return False
+            logger.error(f"Falha ao gravar foto do produto {item['codprod']}: {e}")
+            falhas += 1
+    
+    # Todas as aprovações vão ao Oracle juntas (array binding)
+    atualizacoes = [(item['codprod'], caminho) for item, caminho in arquivos]
+    try:
+        resultado = update_photo_paths(atualizacoes) if arquivos else {}
     except Exception as e:
-        st.error(f"❌ Erro ao salvar: {e}")
-        logger.error(f"Save error: {e}", exc_info=True)
-        return False
+        # Os itens continuam em revisão para uma nova tentativa
+        logger.error(f"Falha ao gravar DIRFOTOPROD da revisão: {e}")
+        resultado = {codprod: (False, str(e)) for codprod, _ in atualizacoes}
+    aprovados = 0
+    for item, _ in arquivos:
+        ok, detalhe = resultado[item['codprod']]
+        if ok:
+            _set_enrichment_status(item['lote_id'], item['codprod'], 'aprovado')
+            aprovados += 1
+        else:
+            logger.error(f"DIRFOTOPROD não gravado para {item['codprod']}: {detalhe}")
+            falhas += 1
+    return aprovados, rejeitados, falhas
+
+
+def cancel_enrichment_queue():
+    """Cancela todos os itens ainda não processados"""
+    with closing(_enrich_connect()) as conn:
+        conn.execute(
+            "UPDATE itens SET status = 'cancelado', atualizado_em = ? WHERE status = 'pendente'",
+            (time.time(),)
+        )
+
+
+def retry_enrichment_errors():
+    """Devolve para a fila os itens que falharam"""
+    with closing(_enrich_connect()) as conn:
+        conn.execute(
+            "UPDATE itens SET status = 'pendente', erro = NULL, atualizado_em = ? WHERE status = 'erro'",
+            (time.time(),)
+        )
 
 # --- 7. MODAL DE DETALHES (COM SALVAMENTO) ---
 # ============================================
@@ -505,9 +3253,18 @@ def show_product_modal(row):
     col_info1, col_info2, col_info3, col_info4 = st.columns(4)
     col_info1.metric("Código", codprod)
     col_info2.metric("EAN Principal", ean_principal or '-')
-    col_info3.metric("Filial", convert_to_python_type(row['CODFILIAL']))
+    filial = row.get('CODFILIAL')
+    col_info3.metric("Filial", convert_to_python_type(filial) if filial is not None else "Todas")
     col_info4.metric("Estoque", f"{convert_to_python_type(row.get('QTEST', 0)):,.0f}")
     
+    # Visão por produto: estoque de cada filial
+    estoques_filial = [
+        f"Filial {col[6:]}: " + (f"{row[col]:,.0f}" if pd.notna(row[col]) else "-")
+        for col in row.index if col.startswith("QTEST_")
+    ]
+    if estoques_filial:
+        st.caption(" | ".join(estoques_filial))
+    
     # NOVO: Exibir múltiplos EANs se existirem
     if qtd_eans > 1:
         st.info(f"ℹ️ Este produto possui **{qtd_eans} códigos de barras** cadastrados")
@@ -530,13 +3287,26 @@ def show_product_modal(row):
         st.subheader("📂 Imagem Cadastrada (WinThor)")
         dir_foto = row.get('DIRFOTOPROD')
         
-        if dir_foto and os.path.exists(dir_foto):
-            try:
-                st.image(dir_foto, caption="Imagem Atual no Sistema", use_container_width=True)
-                st.success(f"✅ Caminho: `{dir_foto}`")
-            except Exception as e:
-                st.error(f"❌ Arquivo corrompido ou inacessível: {e}")
-        else:
+        try:
+            miniatura = get_photo_thumbnail(dir_foto) if dir_foto else None
+        except Exception as e:
+            miniatura = False
+            st.error(f"❌ Arquivo corrompido ou inacessível: {e}")
+        
+        if miniatura:
+            st.image(miniatura, caption="Imagem Atual no Sistema", use_container_width=True)
+            st.success(f"✅ Caminho: `{dir_foto}`")
+            
+            # Outros produtos com a mesma foto (ou muito parecida)
+            semelhantes = similar_photos(codprod)
+            if semelhantes:
+                st.warning(
+                    "⚠️ Foto igual ou parecida com a de outros produtos: " + ", ".join(
+                        f"{outro} ({'idêntica' if distancia == 0 else f'distância {distancia}'})"
+                        for outro, distancia in semelhantes[:10]
+                    )
+                )
+        elif miniatura is None:
             st.info("ℹ️ Nenhuma imagem cadastrada localmente.")
             if dir_foto:
                 st.caption(f"Caminho registrado: `{dir_foto}` (não encontrado)")
@@ -581,7 +3351,9 @@ def show_product_modal(row):
             if st.button("🔍 Buscar Imagens na Web", key=f"btn_{codprod}", type="primary"):
                 with st.spinner("🔄 Consultando Google Imagens..."):
                     # Passa o EAN selecionado para a busca
-                    perform_search(ean_selecionado, desc, cache_key)
+                    resultados = perform_search(ean_selecionado, desc, cache_key)
+                    # Download único dos candidatos; os que falharem ficam de fora
+                    st.session_state.search_candidates[cache_key] = prefetch_candidates(resultados)
                     time.sleep(0.5)
                     st.rerun()
         
@@ -594,18 +3366,27 @@ def show_product_modal(row):
             if ean_selecionado:
                 st.caption(f"🔍 Busca realizada com EAN: `{ean_selecionado}`")
             
+            # Candidatos baixados após a busca e exibidos a partir do cache local
+            candidatos = st.session_state.search_candidates.get(cache_key)
+            if candidatos is None:
+                candidatos = prefetch_candidates(results)
+            candidatos = refetch_missing_candidates(candidatos)
+            st.session_state.search_candidates[cache_key] = candidatos
+            if len(candidatos) < len(results):
+                st.caption(f"⚠️ {len(results) - len(candidatos)} imagens descartadas (inválidas ou inacessíveis)")
+            
             # Grid de imagens (igual ao código anterior)
             selected_img = None
             
-            for i in range(0, len(results), 2):
+            for i in range(0, len(candidatos), 2):
                 cols = st.columns(2)
                 for j, col in enumerate(cols):
                     idx = i + j
-                    if idx < len(results):
+                    if idx < len(candidatos):
                         with col:
-                            item = results[idx]
+                            item = candidatos[idx]
                             try:
-                                st.image(item['link'], use_container_width=True)
+                                st.image(item['thumbnail'], use_container_width=True)
                                 
                                 if st.button(
                                     f"✔️ Selecionar",
@@ -628,7 +3409,10 @@ def show_product_modal(row):
                 with col_save1:
                     if st.button("💾 SALVAR NO SISTEMA", type="primary", use_container_width=True):
                         with st.spinner("💾 Salvando imagem..."):
-                            if save_image_to_winthor(codprod, st.session_state.last_saved_image):
+                            if save_image_to_winthor(
+                                codprod, st.session_state.last_saved_image,
+                                conteudo=read_cached_image(st.session_state.last_saved_image)
+                            ):
                                 st.success("✅ Imagem salva com sucesso!")
                                 st.session_state.last_saved_image = None
                                 time.sleep(1.5)
@@ -655,28 +3439,55 @@ st.caption("Sistema de Gestão de Produtos com Busca Automática de Imagens")
 col_top1, col_top2, col_top3 = st.columns([2, 1, 1])
 with col_top1:
     if st.button("🔄 Atualizar Base de Dados", use_container_width=True):
-        fetch_product_data.clear()
+        invalidate_catalog()
         st.session_state.search_results = {}
+        st.session_state.search_candidates = {}
         logger.info("Cache limpo pelo usuário")
         st.rerun()
 
 with col_top2:
     if st.button("🗑️ Limpar Cache de Imagens", use_container_width=True):
         st.session_state.search_results = {}
+        st.session_state.search_candidates = {}
+        purge_image_cache()
         st.success("✅ Cache limpo!")
         time.sleep(0.5)
         st.rerun()
 
+# Fonte dos dados: catálogo completo em memória ou só as linhas filtradas
+modo_consulta = st.sidebar.radio(
+    "🗄️ Fonte dos dados",
+    QUERY_MODES,
+    index=1 if QUERY_MODE == "oracle" else 0,
+    key='modo_consulta',
+    help=f"'Consulta direta' busca no Oracle só os produtos do filtro (até {PUSHDOWN_MAX_ROWS:,} linhas), sem carregar o catálogo"
+)
+pushdown = modo_consulta == PUSHDOWN_MODE
+
 # Carregar dados
-df = fetch_product_data()
+catalogo = None if pushdown else fetch_product_data()
+start_enrichment_worker()
+df_filtered = pd.DataFrame()
+
+# Idade dos dados e duração da última atualização
+with col_top3:
+    catalog_store = get_catalog_store()
+    if catalog_store['carregado_em']:
+        idade_min = int((time.time() - catalog_store['carregado_em']) / 60)
+        origem = "disco" if catalog_store['origem'] == 'disco' else "Oracle"
+        st.caption(f"🕐 Dados de {idade_min} min atrás ({origem})")
+    if catalog_store['duracao'] is not None:
+        st.caption(f"⚡ Última atualização: {catalog_store['duracao']:.1f}s")
+    if catalog_store['atualizando']:
+        st.caption("🔄 Atualizando em segundo plano...")
 
-if not df.empty:
+if pushdown or (catalogo is not None and not catalogo['estoque'].empty):
     # SIDEBAR - Filtros e Estatísticas
 # ============================================
 # ATUALIZAÇÃO DOS FILTROS (NO MAIN)
 # ============================================
 
-    # Dentro do bloco "if not df.empty:"
+    # Dentro do bloco "if catalogo is not None:"
     with st.sidebar:
         st.header("🔍 Filtros Avançados")
         
@@ -688,18 +3499,32 @@ if not df.empty:
             help="Busca em TODOS os EANs cadastrados do produto"
         )
         
-        f_desc = st.text_input("📝 Descrição (contém)")
+        f_desc = st.text_input(
+            "📝 Descrição",
+            help="Todas as palavras, em qualquer ordem, sem diferenciar acentos; aceita início de palavra (ex.: 'acu crist')"
+        )
+        modo_desc = st.radio(
+            "Modo da busca por descrição",
+            ["Palavras", "Aproximada"],
+            horizontal=True,
+            help=f"'Aproximada' tolera erros de digitação e abreviações e mostra os {FUZZY_TOP_K} produtos mais parecidos"
+        )
+        f_desc_fornecedor = modo_desc == "Aproximada" and st.checkbox("Buscar também no fornecedor")
         
         # Filtros categóricos
         col_f1, col_f2 = st.columns(2)
-        f_filial = col_f1.multiselect("🏢 Filial", options=sorted(df['CODFILIAL'].unique()))
-        f_status = col_f2.multiselect("⚡ Status", options=df['STATUS'].unique())
+        facetas = pushdown_facets() if pushdown else catalogo['facetas']
+        f_filial = col_f1.multiselect("🏢 Filial", options=facetas['filiais']['opcoes'])
+        legenda_filial = col_f1.empty()
+        f_status = col_f2.multiselect("⚡ Status", options=facetas['status']['opcoes'])
+        legenda_status = col_f2.empty()
         
-        f_depto = st.multiselect("🏷️ Departamento", options=sorted(df['DEPARTAMENTO'].dropna().unique()))
+        f_depto = st.multiselect("🏷️ Departamento", options=facetas['deptos']['opcoes'])
+        legenda_depto = st.empty()
         
         # Filtro de dias sem venda
-        max_dias = int(df['DIAS_SEM_VENDA'].max()) if not df['DIAS_SEM_VENDA'].isnull().all() else 0
-        f_dias = st.slider("📅 Dias sem Venda (Mínimo)", 0, max_dias, 0)
+        # max_dias pode ser 0 (sem datas de saída ou opções indisponíveis)
+        f_dias = st.slider("📅 Dias sem Venda (Mínimo)", 0, max(facetas['max_dias'], 1), 0)
         
         st.markdown("---")
         
@@ -716,81 +3541,94 @@ if not df.empty:
             index=0
         )
         
+        modo_visao = st.radio(
+            "🗂️ Linhas da tabela:",
+            ["Por filial", "Por produto"],
+            index=0,
+            help="'Por produto' mostra uma linha por produto com o estoque de cada filial em colunas"
+        )
+        
         st.markdown("---")
         
         # Estatísticas da API
         st.header("📊 Estatísticas da Sessão")
         
-        quota_info = st.session_state.api_quota
-        tempo_reset = int((quota_info['reset_time'] - time.time()) / 60)
+        quota_global = quota_status()
+        quota_hora = quota_global['hora']
+        quota_dia = quota_global['dia']
         
         col_stat1, col_stat2 = st.columns(2)
-        col_stat1.metric("🔍 Buscas API", f"{quota_info['count']}/100")
-        col_stat2.metric("⏱️ Reset em", f"{max(0, tempo_reset)} min")
+        col_stat1.metric("🔍 Restam na Hora", f"{quota_hora['restante']}/{quota_hora['limite']}")
+        col_stat2.metric("📅 Restam no Dia", f"{quota_dia['restante']:,}/{quota_dia['limite']:,}")
+        st.caption(f"Quota compartilhada entre todos os usuários • {st.session_state.api_quota['count']} buscas nesta sessão")
         
         st.metric("💾 Imagens em Cache", len(st.session_state.search_results))
         
-        # Progresso da quota
-        progress = min(quota_info['count'] / 100, 1.0)
-        st.progress(progress)
+        cache_stats = search_cache_stats()
+        consultas_cache = cache_stats['hits'] + cache_stats['misses']
+        taxa_acerto = cache_stats['hits'] / consultas_cache if consultas_cache else 0
+        col_stat3, col_stat4 = st.columns(2)
+        col_stat3.metric("🗄️ Cache Persistente", f"{cache_stats['entradas']:,}")
+        col_stat4.metric("🎯 Acertos", f"{cache_stats['hits']}/{consultas_cache}", f"{taxa_acerto:.0%}", delta_color="off")
         
-        if quota_info['count'] >= 80:
+        # Progresso da quota horária (consumo global)
+        progress = min(1 - quota_hora['restante'] / quota_hora['limite'], 1.0) if quota_hora['limite'] else 1.0
+        st.progress(max(progress, 0.0))
+        
+        if progress >= 0.8:
             st.warning("⚠️ Quota próxima do limite!")
 
-    # Aplicação dos Filtros
-    df_filtered = df.copy()
-    
-    if f_cod: 
-        df_filtered = df_filtered[df_filtered['CODPROD'].astype(str) == f_cod]
+    # Aplicação dos Filtros (máscara única, sem cópias intermediárias)
+    filter_spec = build_filter_spec(
+        cod=f_cod, ean=f_ean, desc=f_desc,
+        filiais=f_filial, status=f_status, deptos=f_depto,
+        dias_min=f_dias, foto=opcao_foto, exclusao=opcao_exclusao,
+        aproximada=(modo_desc == "Aproximada"), fornecedor=f_desc_fornecedor
+    )
     
-    # FILTRO EAN ATUALIZADO - Busca em todos os EANs
-    if f_ean:
+    if filter_spec['ean']:
         logger.info(f"Filtrando por EAN: {f_ean}")
-        df_filtered = df_filtered[
-            df_filtered.apply(lambda row: has_ean(row['TODOS_EANS'], f_ean), axis=1)
-        ]
-        logger.info(f"Produtos encontrados: {len(df_filtered)}")
     
-    if f_desc: 
-        df_filtered = df_filtered[
-            df_filtered['DESCRICAO'].str.contains(f_desc, case=False, na=False)
-        ]
-
-    if f_filial: 
-        df_filtered = df_filtered[df_filtered['CODFILIAL'].isin(f_filial)]
+    # Consulta direta: o Oracle devolve só as linhas do filtro, refinadas abaixo
+    if pushdown:
+        try:
+            with st.spinner("🔎 Consultando o Oracle..."):
+                catalogo, truncado = query_catalog(filter_spec)
+            if truncado:
+                st.warning(f"⚠️ Mais de {PUSHDOWN_MAX_ROWS:,} linhas no Oracle: refine o filtro para ver todas.")
+        except Exception as e:
+            st.error(f"❌ Erro na consulta direta: {e}")
+            logger.error(f"Erro SQL (consulta direta): {e}")
+            catalogo = None
     
-    if f_status: 
-        df_filtered = df_filtered[df_filtered['STATUS'].isin(f_status)]
+    if catalogo is not None:
+        posicoes_filtradas, similaridade = compute_filter_positions(catalogo, filter_spec)
+        df_filtered = build_catalog_view(
+            catalogo, posicoes_filtradas, por_produto=(modo_visao == "Por produto"),
+            similaridade=similaridade
+        )
+    else:
+        df_filtered = pd.DataFrame(columns=CATALOG_COLUMNS)
     
-    if f_depto: 
-        df_filtered = df_filtered[df_filtered['DEPARTAMENTO'].isin(f_depto)]
+    if filter_spec['ean']:
+        logger.info(f"Produtos encontrados: {len(df_filtered)}")
     
-    df_filtered = df_filtered[df_filtered['DIAS_SEM_VENDA'] >= f_dias]
-
-    # Filtro de foto
-    if opcao_foto == "✅ Com Foto":
-        df_filtered = df_filtered[df_filtered['DIRFOTOPROD'].notna() & (df_filtered['DIRFOTOPROD'] != '')]
-    elif opcao_foto == "❌ Sem Foto":
-        df_filtered = df_filtered[df_filtered['DIRFOTOPROD'].isna() | (df_filtered['DIRFOTOPROD'] == '')]
-
-    # Filtro de exclusão
-    if opcao_exclusao == "Apenas Ativos":
-        df_filtered = df_filtered[df_filtered['DTEXCLUSAO'].isna()]
-    elif opcao_exclusao == "Apenas Excluídos":
-        df_filtered = df_filtered[df_filtered['DTEXCLUSAO'].notna()]
-
-    # Adicionar coluna visual de status da foto
-    df_filtered['STATUS_FOTO'] = df_filtered['DIRFOTOPROD'].apply(
-        lambda x: '✅' if pd.notna(x) and x != '' else '❌'
-    )
+    # Contagem de cada opção das facetas no filtro atual (precisa do catálogo completo)
+    if not pushdown:
+        contagens = compute_facet_counts(
+            catalogo, filter_spec, posicoes_filtradas, por_produto=(modo_visao == "Por produto")
+        )
+        legenda_filial.caption(facet_caption(contagens['filiais'], f_filial))
+        legenda_status.caption(facet_caption(contagens['status'], f_status))
+        legenda_depto.caption(facet_caption(contagens['deptos'], f_depto))
 
     # Métricas Principais
     col_m1, col_m2, col_m3, col_m4 = st.columns(4)
     col_m1.metric("📦 Produtos", f"{len(df_filtered):,}")
     col_m2.metric("📊 Estoque Total", f"{df_filtered['QTEST'].sum():,.0f}")
     
-    com_foto = len(df_filtered[df_filtered['STATUS_FOTO'] == '✅'])
-    sem_foto = len(df_filtered[df_filtered['STATUS_FOTO'] == '❌'])
+    com_foto = int((df_filtered['STATUS_FOTO'] == '✅').sum())
+    sem_foto = len(df_filtered) - com_foto
     col_m3.metric("✅ Com Foto", com_foto)
     col_m4.metric("❌ Sem Foto", sem_foto)
 
@@ -813,18 +3651,53 @@ if not df_filtered.empty:
     col_d1.metric("Linhas", f"{linhas:,}")
     col_d2.metric("Tamanho", f"{tamanho_mb:.2f} MB")
     
-    # 2. Tempo de renderização
+    mb_antes, mb_depois = catalogo['memoria_mb']
+    if pushdown:
+        st.sidebar.caption(f"Consulta direta: {len(catalogo['estoque']):,} linhas trazidas do Oracle ({mb_depois:.1f} MB)")
+    else:
+        st.sidebar.caption(f"Catálogo em memória: {mb_antes:.1f} MB → {mb_depois:.1f} MB (tipos compactos)")
+    
+    # 2. Paginação (somente a página atual é enviada ao navegador)
+    colunas_tabela = table_columns(df_filtered)
+    col_p1, col_p2, col_p3 = st.columns([1, 2, 1])
+    page_size = col_p1.selectbox("Linhas por página", PAGE_SIZE_OPTIONS, index=1)
+    sort_col = col_p2.selectbox(
+        "Ordenar por",
+        [None] + colunas_tabela,
+        format_func=lambda c: "(ordem padrão)" if c is None else c
+    )
+    ascending = col_p3.radio("Ordem", ["↑", "↓"], horizontal=True) == "↑"
+    
+    total_paginas = max(1, -(-linhas // page_size))
+    
+    # Volta para a primeira página quando os filtros mudam
+    assinatura_filtro = (repr(filter_spec), modo_visao, page_size, sort_col, ascending)
+    if st.session_state.get('assinatura_filtro') != assinatura_filtro:
+        st.session_state.assinatura_filtro = assinatura_filtro
+        st.session_state.pagina_tabela = 1
+    st.session_state.pagina_tabela = min(st.session_state.get('pagina_tabela', 1), total_paginas)
+    
+    # 3. Tempo de renderização
     start_render = time.time()
+    
+    df_page, total_paginas = get_page(
+        df_filtered, st.session_state.pagina_tabela, page_size, sort_col, ascending
+    )
+    
+    # Miniaturas das fotos da página ficam prontas antes de abrir o modal
+    prewarm_photo_thumbnails(df_page['DIRFOTOPROD'].dropna())
 
     event = st.dataframe(
-        df_filtered,
+        df_page,
         use_container_width=True,
         hide_index=True,
-        column_order=[
-            "STATUS_FOTO", "CODFILIAL", "CODPROD", "DESCRICAO", 
-            "EAN", "QTEST", "DIAS_SEM_VENDA", "STATUS", "DTEXCLUSAO"
-        ],
+        column_order=colunas_tabela,
         column_config={
+            **{
+                col: st.column_config.NumberColumn(f"Estoque F{col[6:]}", format="%.0f", width="small")
+                for col in colunas_tabela if col.startswith("QTEST_")
+            },
+            "SIMILARIDADE": st.column_config.ProgressColumn("Similaridade", min_value=0, max_value=1, format="%.2f", width="small"),
             "STATUS_FOTO": st.column_config.TextColumn("📷", width="small", help="Status da foto no sistema"),
             "CODFILIAL": st.column_config.NumberColumn("Filial", width="small"),
             "CODPROD": st.column_config.NumberColumn("Código", width="small"),
@@ -838,6 +3711,24 @@ if not df_filtered.empty:
         on_select="rerun",
         selection_mode="single-row"
     )
+    
+    # Navegação entre páginas
+    col_n1, col_n2, col_n3 = st.columns([1, 2, 1])
+    col_n1.button(
+        "◀ Anterior", use_container_width=True,
+        disabled=st.session_state.pagina_tabela <= 1,
+        on_click=_mudar_pagina, args=(-1, total_paginas)
+    )
+    col_n2.number_input(
+        f"Página (de {total_paginas:,})",
+        min_value=1, max_value=total_paginas, step=1,
+        key='pagina_tabela'
+    )
+    col_n3.button(
+        "Próxima ▶", use_container_width=True,
+        disabled=st.session_state.pagina_tabela >= total_paginas,
+        on_click=_mudar_pagina, args=(1, total_paginas)
+    )
 
     render_time = time.time() - start_render
     
@@ -846,11 +3737,8 @@ if not df_filtered.empty:
     else:
         st.sidebar.success(f"✅ Renderização: {render_time:.2f}s")
     
-    # 3. Recomendações
-    if linhas > 1000:
-        st.sidebar.error("❌ Muitas linhas! Use paginação.")
-    elif linhas > 500:
-        st.sidebar.warning("⚠️ Considere adicionar paginação.")
+    # 4. Recomendações
+    st.sidebar.caption(f"Renderizadas: {len(df_page):,} linhas (página {st.session_state.pagina_tabela}/{total_paginas:,})")
     
     if tamanho_mb > 10:
         st.sidebar.error("❌ DataFrame muito grande!")
@@ -860,24 +3748,100 @@ if not df_filtered.empty:
     # Abre modal ao selecionar linha
     if len(event.selection['rows']) > 0:
         idx = event.selection['rows'][0]
-        show_product_modal(df_filtered.iloc[idx])
+        show_product_modal(df_page.iloc[idx])
 
-    # Exportação Excel
+    # Exportação (gerada só quando pedida e reaproveitada enquanto o filtro não muda)
     st.markdown("---")
     col_exp1, col_exp2 = st.columns([3, 1])
     
+    with col_exp1:
+        formato_exp = st.radio(
+            "📤 Formato da exportação", list(EXPORT_FORMATS), horizontal=True
+        )
+    
     with col_exp2:
-        output = BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df_filtered.to_excel(writer, index=False, sheet_name='Analise_Produtos')
+        extensao_exp, mime_exp = EXPORT_FORMATS[formato_exp]
+        chave_exp = (catalogo['versao'], repr(filter_spec), modo_visao, formato_exp)
+        exportacao = st.session_state.get('exportacao')
         
-        st.download_button(
-            label="📥 Exportar para Excel",
-            data=output.getvalue(),
-            file_name=f"relatorio_produtos_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            use_container_width=True
+        if exportacao and exportacao['chave'] == chave_exp:
+            st.download_button(
+                label=f"📥 Baixar {formato_exp}",
+                data=exportacao['dados'],
+                file_name=exportacao['nome'],
+                mime=mime_exp,
+                use_container_width=True
+            )
+        elif st.button(f"📦 Gerar {formato_exp} ({linhas:,} linhas)", use_container_width=True):
+            with st.spinner(f"📦 Gerando {formato_exp}..."):
+                st.session_state.exportacao = {
+                    'chave': chave_exp,
+                    'dados': build_export(df_filtered, formato_exp),
+                    'nome': f"relatorio_produtos_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{extensao_exp}"
+                }
+            st.rerun()
+
+    # Busca de fotos em lote para os produtos filtrados sem foto
+    st.markdown("---")
+    with st.expander("🤖 Busca de Fotos em Lote", expanded=False):
+        sem_foto = df_filtered.loc[df_filtered['STATUS_FOTO'] == '❌'].drop_duplicates('CODPROD')
+        progresso = enrichment_progress()
+        
+        col_l1, col_l2, col_l3, col_l4 = st.columns(4)
+        col_l1.metric("⏳ Na Fila", progresso.get('pendente', 0) + progresso.get('buscando', 0))
+        col_l2.metric("👀 Para Revisar", progresso.get('revisao', 0))
+        col_l3.metric("✅ Aprovados", progresso.get('aprovado', 0))
+        col_l4.metric("⚠️ Sem Resultado/Erro", progresso.get('sem_resultado', 0) + progresso.get('erro', 0))
+        
+        col_a1, col_a2, col_a3 = st.columns([2, 1, 1])
+        qtd_lote = min(len(sem_foto), ENRICH_MAX_ITEMS)
+        if col_a1.button(
+            f"🚀 Buscar fotos para {qtd_lote:,} produtos sem foto (filtro atual)",
+            disabled=qtd_lote == 0, use_container_width=True
+        ):
+            _, inseridos = create_enrichment_job(
+                sem_foto, f"{qtd_lote} produtos em {datetime.now().strftime('%d/%m/%Y %H:%M')}"
+            )
+            st.success(f"✅ {inseridos} produtos enviados para a fila")
+        if col_a2.button("🔁 Reprocessar Erros", use_container_width=True, disabled=not progresso.get('erro')):
+            retry_enrichment_errors()
+            st.rerun()
+        if col_a3.button("⏹️ Cancelar Fila", use_container_width=True, disabled=not progresso.get('pendente')):
+            cancel_enrichment_queue()
+            st.rerun()
+        
+        st.caption(
+            f"Processado em segundo plano com {ENRICH_WORKERS} buscas simultâneas; "
+            f"pausa quando restam {ENRICH_QUOTA_RESERVE} buscas na hora."
         )
+        
+        # Fila de revisão: aprovação em bloco
+        revisao = refresh_review_candidates(list_review_items())
+        if revisao:
+            with st.form("revisao_lote"):
+                st.write(f"**Revisão** ({len(revisao)} de {progresso.get('revisao', 0):,})")
+                escolhas = []
+                for item in revisao:
+                    st.markdown(f"**{item['codprod']}** - {item['descricao']}")
+                    cols = st.columns(len(item['candidatos']) + 1)
+                    for i, candidato in enumerate(item['candidatos']):
+                        if os.path.exists(candidato['thumbnail']):
+                            cols[i].image(candidato['thumbnail'], caption=f"Opção {i + 1}", use_container_width=True)
+                        else:
+                            cols[i].caption(f"Opção {i + 1}: imagem indisponível")
+                    opcoes = ["Rejeitar"] + [f"Opção {i + 1}" for i in range(len(item['candidatos']))]
+                    escolha = cols[-1].radio(
+                        "Escolha", opcoes, index=1,
+                        key=f"lote_{item['lote_id']}_{item['codprod']}", label_visibility="collapsed"
+                    )
+                    escolhas.append((item, opcoes.index(escolha) - 1 if escolha != "Rejeitar" else None))
+                
+                if st.form_submit_button("💾 Aplicar Revisão", type="primary", use_container_width=True):
+                    with st.spinner("💾 Salvando imagens aprovadas..."):
+                        aprovados, rejeitados, falhas = review_enrichment_items(escolhas)
+                    st.success(f"✅ {aprovados} aprovadas, {rejeitados} rejeitadas, {falhas} falhas")
+                    time.sleep(1)
+                    st.rerun()
 
 else:
     st.info("ℹ️ Nenhum dado carregado. Verifique a conexão com o banco de dados.")